@@ -4,6 +4,7 @@
 
 import argparse
 import random
+import rpreddtypes
 
 
 parser = argparse.ArgumentParser(description='Split data into '
@@ -37,24 +38,17 @@ parser.add_argument('--validation-count', type=int,
 args = parser.parse_args()
 
 
-vetoes = []
+vetoes = rpreddtypes.RpVetoSet()
 
 if args.vetoset:
-    with open(args.vetoset, 'r') as ifile:
-        for record in ifile:
-            fields = record.split()
-            vetoes.append(int(fields[0]))
+    vetoes.load(args.vetoset)
 
 validcandidates = []
 trainingset = []
 validationset = []
 
 with open(args.inputfile, 'r') as ifile:
-    for record in ifile:
-        fields = record.split()
-        if int(fields[0]) in vetoes:
-            continue
-        validcandidates.append(record)
+    validcandidates = vetoes.filterRecords(ifile.readlines())
 
 random.shuffle(validcandidates)
 numValid = len(validcandidates)
@@ -5,12 +5,15 @@ import argparse
 import sys
 import numpy as np
 import random
-import keras
+import rplive
 import tkinter
 import os
 import configparser
 import datetime
 import threading
+import queue
+import base64
+import time
 
 
 # Main code starts here
@@ -36,7 +39,8 @@ class BaseWidget():
     def __init__(self, root, rwidth, rheight, csize, hcolour,
                  noRainColour, maybeRainColour, yesRainColour,
                  noRainLimit, yesRainLimit, canvasBg,
-                 loopTime, network, gifFormat, binFormat, lockfile):
+                 loopTime, network, gifFormat, binFormat, lockfile,
+                 policy, frameIndexFile = None, client = None):
         self.root = root
         self.width = rwidth
         self.height = rheight
@@ -53,11 +57,19 @@ class BaseWidget():
         self.gifFormat = gifFormat
         self.binFormat = binFormat
         self.lockfile = lockfile
+        self.policy = policy
+        self.client = client
+        self.source = rplive.LiveFrameSource(binFormat, frameIndexFile,
+                                             lockfile,
+                                             watcher = rplive.FrameWatcher())
+        self.ring = rplive.FrameRing(policy)
         
         self.lastUpdate = tkinter.StringVar()
         self.lastUpdate.set('NO LAST UPDATE')
         self.gifFileNames = [ None ] * 6
         self.binFileNames = [ None ] * 6
+        self.lastWindow = None    # used by the loader thread only
+        self.results = queue.Queue()
         self.needRefresh = 1
         self.gwin = None
         self.giflabel = None
@@ -78,11 +90,18 @@ class BaseWidget():
         self.canvas.pack()
         self.vals = [-1] * 10
         self.gifImages = [ None ] * 6
+        self.gifData = [ None ] * 6
+        self.decodedGifs = [ None ] * 6
         self.gifnum = 0
-        self.validDate = ''  # last time we had valid data
+        self.validDate = None  # last time we had valid data
 
         self.drawScreen()
 
+        # File I/O and prediction happen here, results are picked up
+        # by updateValues() in the Tk thread
+        self.loader = threading.Thread(target = self.loadLoop, daemon = True)
+        self.loader.start()
+
     def makeGifWindow(self):
         self.mutex.acquire()
         if self.gwin:
@@ -90,9 +109,13 @@ class BaseWidget():
             return
         self.gwin = tkinter.Toplevel()
         self.gwin.wm_title("Radar Images")
+        while self.decodeNextGif():
+            pass
         for i in range(6):
-            self.gifImages[i] = tkinter.PhotoImage(file = self.gifFileNames[i],
-                                                   format = "gif")
+            self.gifImages[i] = self.decodedGifs[i]
+            if not self.gifImages[i]:
+                self.gifImages[i] = tkinter.PhotoImage(
+                    file = self.gifFileNames[i], format = "gif")
         self.giflabel = tkinter.Label(self.gwin,
                                       height = self.gifImages[0].height(),
                                       width = self.gifImages[0].width(),
@@ -112,6 +135,23 @@ class BaseWidget():
         self.mutex.release()
 
 
+    def decodeNextGif(self):
+        """
+        Makes an image from the next GIF read by the loader thread, so
+        that the GIF window opens without decoding them all at once.
+        Returns False if there was none left.
+        """
+        for i in range(6):
+            if self.gifData[i] and not self.decodedGifs[i]:
+                try:
+                    self.decodedGifs[i] = tkinter.PhotoImage(
+                        data = self.gifData[i], format = "gif")
+                except tkinter.TclError:
+                    pass
+                self.gifData[i] = None
+                return True
+        return False
+
     def rotateGifs(self):
         self.mutex.acquire()
         if not self.gwin:
@@ -172,89 +212,114 @@ class BaseWidget():
         self.canvas.pack(fill=tkinter.BOTH, expand=1)
 
 
+    def staleData(self, now):
+        if self.validDate and now - self.validDate > datetime.timedelta(0, 1800):
+            self.results.put(('stale', None))
+
+    def readGif(self, filename):
+        try:
+            with open(filename, 'rb') as ifile:
+                return base64.b64encode(ifile.read()).decode('ascii')
+        except OSError:
+            return None
+
     def loadNewBinFiles(self):
+        """
+        Runs in the loader thread.  Puts a new prediction, with the
+        names and contents of its GIFs, on the results queue, or
+        reports stale data.
+        """
 
-        monthdata = [ None,
-                      0.16, 0, 0.16, 0.33, 0.5, 0.67,
-                      0.83, 1, 0.83, 0.67, 0.5, 0.33 ]
-        
         now = datetime.datetime.utcnow()
-        nowYear = now.year
-        nowMonth = now.month
-        nowDay = now.day
-        nowHour = now.hour
 
         # round to previous 10-minute interval
         nowMinute = int( now.minute / 10 ) * 10
 
         now = now.replace(minute = nowMinute)
 
-        if self.lockfile and os.path.exists(self.lockfile):
-            return
-
-        for retry in range(3):
-            gooddat = True
-            for inum in range(6):
-                delta = datetime.timedelta(0, 600 * (retry + 5 - inum))
-                dtime = now - delta
-                dYear = dtime.year
-                dMonth = dtime.month
-                dDay = dtime.day
-                dHour = dtime.hour
-                dMin = dtime.minute
-                self.binFileNames[inum] = ( self.binFormat.format(YEAR = dYear, MONTH = dMonth, DAY = dDay, HOUR = dHour, MIN = dMin) )
-                self.gifFileNames[inum] = ( self.gifFormat.format(YEAR = dYear, MONTH = dMonth, DAY = dDay, HOUR = dHour, MIN = dMin) )
-                if not os.path.exists(self.binFileNames[inum]):
-                    if retry == 2:
-                        if now - self.validDate > datetime.timedelta(0, 1800):
-                            self.updateLabel.configure(bg = "Yellow")
-                        return
-
-                    gooddat = False
-
-            if gooddat:
-                thisstring = ('{YEAR:04d}_{MONTH:02d}_{DAY:02d}_{HOUR:02d}_{MINUTE:02d}'
-                              .format(YEAR=dYear,
-                                      MONTH=dMonth,
-                                      DAY=dDay,
-                                      HOUR=dHour,
-                                      MINUTE=dMin))
-
-                break
-
-
-        if thisstring == self.lastUpdate:
+        if self.client:
+            result = self.client.getPrediction()
+            if not result:
+                self.staleData(now)
+                return
+            lastSeqno, vals = result
+            lastTime = rpreddtypes.sequenceNumberToDatetime(lastSeqno)
+            dtimes = [ lastTime - datetime.timedelta(0, 600 * (5 - inum))
+                       for inum in range(6) ]
+        else:
+            # Only look for the files when the watcher has seen
+            # something change, or the interval has moved on
+            if not self.source.hasChanged(now):
+                return
+            if self.source.isLocked():
+                return
+            window = self.source.findLatestWindow(now)
+            if not window:
+                self.staleData(now)
+                return
+            dtimes, self.binFileNames = window
+
+        lastTime = dtimes[-1]
+        thisstring = ('{YEAR:04d}_{MONTH:02d}_{DAY:02d}_{HOUR:02d}_{MINUTE:02d}'
+                      .format(YEAR=lastTime.year,
+                              MONTH=lastTime.month,
+                              DAY=lastTime.day,
+                              HOUR=lastTime.hour,
+                              MINUTE=lastTime.minute))
+
+        if thisstring == self.lastWindow:
+            # The daemon may be serving an old result
+            self.staleData(now)
             return
 
-        reader = rpreddtypes.RpBinReader()
-        reader.read(self.binFileNames[0])
-        rpbo = reader.getPreparedDataObject()
-        datasize = rpbo.getDataLength()
-
-        xvals = np.empty([1, 6, datasize])
-        mvals = np.empty([1, 1])
-
-        for timestep in range(6):
-            reader = rpreddtypes.RpBinReader()
-            reader.read(self.binFileNames[timestep])
-            rpbo = reader.getPreparedDataObject()
-            xvals[0][timestep] = np.asarray(rpbo.getPreparedData()) / 255
-
-        
-        mvals[0][0] = monthdata[nowMonth]
-        self.vals = self.network.predict([xvals, mvals])[0]
-        self.lastUpdate.set(thisstring)
+        if not self.client:
+            rawvals = self.ring.getWindow(
+                rpreddtypes.datetimeToSequenceNumber(lastTime),
+                self.binFileNames)
+            vals = rplive.predictWindow(self.network, self.policy, rawvals,
+                                        dtimes[0].month)
+
+        gifFileNames = [ self.gifFormat.format(YEAR = dtime.year,
+                                               MONTH = dtime.month,
+                                               DAY = dtime.day,
+                                               HOUR = dtime.hour,
+                                               MIN = dtime.minute)
+                         for dtime in dtimes ]
+        gifData = [ self.readGif(name) for name in gifFileNames ]
+
+        self.results.put(('update', (thisstring, vals, gifFileNames, gifData)))
+        self.lastWindow = thisstring
         self.validDate = now
-        self.updateLabel.configure(bg = "White")
-        self.needRefresh = 1
-        
+
+    def loadLoop(self):
+        while True:
+            try:
+                self.loadNewBinFiles()
+            except Exception as ex:
+                self.source.invalidate()
+            time.sleep(self.loopTime / 1000)
 
     def updateValues(self):
-        try:
-            self.loadNewBinFiles()
-            self.updateScreen()
-        except Exception as ex:
-            return
+        """
+        Shows whatever the loader thread has produced since the last
+        call, and decodes one of its GIFs
+        """
+        while True:
+            try:
+                kind, result = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'stale':
+                self.updateLabel.configure(bg = "Yellow")
+                continue
+            thisstring, self.vals, self.gifFileNames, self.gifData = result
+            self.decodedGifs = [ None ] * 6
+            self.lastUpdate.set(thisstring)
+            self.updateLabel.configure(bg = "White")
+            self.needRefresh = 1
+
+        self.updateScreen()
+        self.decodeNextGif()
 
 
 def worker(screen):
@@ -292,21 +357,26 @@ yesRainThreshold = float(config.get('Graphics', 'YesRainThreshold',
 refreshTime = int(config.get('Graphics', 'GifSpeedMs',
                              fallback=refreshTime))
 
-savedNetwork = config.get('Network', 'SavedNetwork')
+savedNetwork = config.get('Network', 'SavedNetwork', fallback=None)
+daemonSocket = config.get('Network', 'Daemon', fallback=None)
 gifFileFormatString = config.get('Data', 'GifFiles')
-binFileFormatString = config.get('Data', 'BinFiles')
+binFileFormatString = config.get('Data', 'BinFiles', fallback=None)
+frameIndexFile = config.get('Data', 'FrameIndex', fallback=None)
 lockfile = config.get('Data', 'LockFile')
+computeDtype = config.get('Network', 'Dtype', fallback='float32')
 
-if not savedNetwork:
-    print('Need a saved network for producing predictions')
+if not savedNetwork and not daemonSocket:
+    print('Need a saved network or a prediction daemon for producing '
+          'predictions')
     sys.exit(1)
 
 if not gifFileFormatString:
     print ('Need a gif file format string for graphical display')
     sys.exit(1)
 
-if not binFileFormatString:
-    print ('Need a bin file format string to load data for the predictions')
+if not daemonSocket and not binFileFormatString and not frameIndexFile:
+    print ('Need a bin file format string or a frame index to load data '
+           'for the predictions')
     sys.exit(1)
         
     
@@ -319,7 +389,14 @@ if not binFileFormatString:
 # nowMinute = int( now.minute / 10 ) * 10   # round to previous 10-minute interval
 
 
-network = keras.models.load_model(savedNetwork)
+network = None
+client = None
+if daemonSocket:
+    client = rplive.PredictionClient(daemonSocket)
+else:
+    # Only needed when predicting here rather than in the daemon
+    import keras
+    network = keras.models.load_model(savedNetwork)
     
 root = tkinter.Tk()
 
@@ -329,7 +406,8 @@ widget = BaseWidget(root, baseWidth, baseHeight,
                     rainColour, noRainThreshold, yesRainThreshold,
                     canvasColour, refreshTime,
                     network, gifFileFormatString, binFileFormatString,
-                    lockfile)
+                    lockfile, rpreddtypes.RpDtypePolicy(computeDtype),
+                    frameIndexFile, client)
 
 root.after(refreshTime, worker, widget)
 root.mainloop()
@@ -40,6 +40,8 @@
 # sequence numbers.
 
 import argparse
+import sys
+import numpy as np
 import rpreddtypes
 
 parser = argparse.ArgumentParser(description='Find training candidates.',
@@ -95,41 +97,54 @@ if skipRotations:
     nRots = 0
 
 # Now, we've loaded sequence numbers into a list, and indexed a dict
-# against them to record number of rotations and rain data.  
-
-# Find runs of 36.
-
-idx = 0
-while idx < len(seqnoList) - 36:
-    candSeqNo = seqnoList[idx]
-    
-    offset = 1
-    invalid = False
-    while not invalid and offset < 36:
-        if seqnoList[idx + offset] != seqnoList[idx + offset - 1] + 1:
-            invalid = True
-            idx = idx + offset
-
-        offset += 1
-
-    if invalid:
-        continue
-
+# against them to record number of rotations and rain data.
+
+# Find runs of 36.  A candidate can start at index idx if each of the
+# next 35 sequence numbers is one more than the one before it, so
+# count the breaks between neighbours and take differences of the
+# running count.  As before, the last possible start is not tried.
+
+seqnos = np.asarray(seqnoList, dtype=np.int64)
+nStarts = max(len(seqnos) - 36, 0)
+breaks = np.concatenate([ [ 0 ],
+                          np.cumsum(seqnos[1:] != seqnos[:-1] + 1) ])
+starts = np.nonzero(breaks[35:35 + nStarts] == breaks[:nStarts])[0]
+
+# The rain data in sequence number order, one row per distinct
+# sequence number.  The 36 rows of a candidate are consecutive.
+
+uniqueSeqnos = np.unique(seqnos)
+nCols = (nRots + 1) * 2
+rainData = np.array([ parsedData[seqno][1:1 + nCols]
+                      for seqno in uniqueSeqnos.tolist() ],
+                    dtype=np.int64).reshape(len(uniqueSeqnos), nCols)
+rows = np.searchsorted(uniqueSeqnos, seqnos[starts])
+
+# Running counts of rain records, so that each 6-step bin is an OR
+# found as a difference of two counts
+
+rainCounts = np.concatenate([ np.zeros((1, nCols), dtype=np.int64),
+                              np.cumsum(rainData == 1, axis=0) ])
+
+rainingNow = rainData[rows + 5].tolist()
+binned = np.empty((len(rows), 5, nCols), dtype=np.int64)
+for timeInterval in range(5):
+    first = rows + 6 + timeInterval * 6
+    binned[:, timeInterval] = ( rainCounts[first + 6]
+                                - rainCounts[first] > 0 )
+
+# [candidate, rotation, the 10 binned values]
+binnedValues = ( binned.reshape(len(rows), 5, nRots + 1, 2)
+                 .transpose(0, 2, 1, 3)
+                 .reshape(len(rows), nRots + 1, 10).tolist() )
+
+output = []
+for index, candSeqNo in enumerate(seqnos[starts].tolist()):
     for rot in range(nRots + 1):
-        lastHistoricalRecord = parsedData[candSeqNo + 5]
-        rainingNow = lastHistoricalRecord[1 + rot * 2]
         record = '{0} {1} {2} {3} {4} '.format(candSeqNo, hashval,
-                                               rainingNow, nRots, rot)
-        binnedValues = [ 0, 0, 0, 0, 0, 0, 0, 0, 0, 0 ]
-        for timeInterval in range(5):
-            for snapshot in range(6):
-                oneRec = parsedData[candSeqNo + 6 + timeInterval * 6 + snapshot]
-                if oneRec[1 + rot * 2] == 1:
-                    binnedValues[timeInterval * 2] = 1
-                if oneRec[1 + rot * 2 + 1] == 1:
-                    binnedValues[timeInterval * 2 + 1] = 1
-
-        print(record, *binnedValues, sep = ' ')
-
-    idx += 1
-    
+                                               rainingNow[index][rot * 2],
+                                               nRots, rot)
+        output.append('{0} {1}\n'.format(
+            record, ' '.join(map(str, binnedValues[index][rot]))))
+
+sys.stdout.write(''.join(output))
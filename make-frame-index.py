@@ -0,0 +1,83 @@
+#! /usr/bin/python3
+
+# Builds or updates the frame index of an archive, see
+# rpreddtypes.RpFrameIndex, from the sequence file written by
+# prepare-true-vals.py.  make-rain-inputs.py --frame-index already
+# records the pathname, total rain and maxval of the files it
+# converts; this adds the rain labels and availability, and can fill
+# in the header values for files converted without it.
+
+import argparse
+import os
+import sys
+import numpy as np
+import rpreddtypes
+
+
+parser = argparse.ArgumentParser(description='Build a frame index '
+                                 'from a sequence file.')
+parser.add_argument('--sequences', type=str, dest='sequences',
+                    required=True,
+                    help='A file of sequence information from '
+                    'prepare-true-vals.py')
+parser.add_argument('--output', type=str, dest='output',
+                    required=True,
+                    help='The frame index to write.  If it exists, '
+                    'it is updated.')
+parser.add_argument('--read-headers', action='store_true',
+                    dest='readHeaders',
+                    help='Read the total rain and maxval from the '
+                    'headers of files the index has no values for.')
+parser.add_argument('--verbose', type=bool, dest='verbose',
+                    default = False,
+                    help='Extra output during processing')
+
+args = parser.parse_args()
+
+seqnos = []
+paths = []
+labels = []
+with open(args.sequences, 'r') as ifile:
+    for record in ifile:
+        fields = record.split()
+        seqnos.append(int(fields[0]))
+        paths.append(fields[1])
+        labels.append(list(map(int, fields[4:])))
+
+if not seqnos:
+    print('No sequence numbers found in {0}'.format(args.sequences))
+    sys.exit(1)
+
+# Pad to a common width, in case the rotation counts differ
+labelWidth = max(map(len, labels))
+labelArray = np.full((len(labels), labelWidth), -1, dtype=np.int8)
+for row in range(len(labels)):
+    labelArray[row, :len(labels[row])] = labels[row]
+
+frameIndex = rpreddtypes.RpFrameIndex()
+if os.path.exists(args.output):
+    frameIndex.load(args.output)
+
+available = [ os.path.exists(path) for path in paths ]
+frameIndex.update(seqnos, paths = paths, labels = labelArray,
+                  available = available)
+
+if args.readHeaders:
+    missing = frameIndex.getSeqnos()[ frameIndex.available &
+                                      (frameIndex.totalRain < 0) ]
+    totalRain = []
+    maxval = []
+    for seqno in missing.tolist():
+        reader = rpreddtypes.RpBinReader()
+        reader.readHeader(frameIndex.getPath(seqno))
+        totalRain.append(reader.getTotalRain())
+        maxval.append(reader.getMaxRainval())
+    if len(missing):
+        frameIndex.update(missing, totalRain = totalRain, maxval = maxval)
+
+frameIndex.write(args.output)
+
+if args.verbose:
+    print('Indexed {0} sequence numbers, {1} available, into {2}'
+          .format(len(frameIndex), int(frameIndex.available.sum()),
+                  args.output))
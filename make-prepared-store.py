@@ -0,0 +1,74 @@
+#! /usr/bin/python3
+
+# Packs the prepared data vectors of every intermediate binary file
+# in a pathfile into a single store file, see
+# rpreddtypes.RpPreparedStore.  Training and inference can then
+# memory-map the store instead of opening one .bin file per timestep.
+
+import argparse
+import sys
+import rpreddtypes
+
+
+parser = argparse.ArgumentParser(description='Build a prepared-data '
+                                 'store from intermediate binary files.')
+parser.add_argument('--pathfile', type=str, dest='pathfile',
+                    required=True,
+                    help='The file that maps sequence numbers to '
+                    'the pathnames of the binary files, the output of '
+                    'prepare-true-vals.py or a frame index.')
+parser.add_argument('--output', type=str, dest='output',
+                    required=True,
+                    help='The pathname of the store to write.')
+parser.add_argument('--verbose', type=bool, dest='verbose',
+                    default = False,
+                    help='Extra output during processing')
+
+args = parser.parse_args()
+
+pathmap = rpreddtypes.openPathMap(args.pathfile)
+seqnos = sorted(pathmap.keys())
+if not seqnos:
+    print('No frames found in {0}'.format(args.pathfile))
+    sys.exit(1)
+
+# Need the size of the data samples, so load the first readable data
+# file up front
+datasize = None
+for seqno in seqnos:
+    try:
+        datasize = len(rpreddtypes.readPreparedData(pathmap[seqno]))
+        break
+    except (OSError, rpreddtypes.RpBinFileReadError):
+        pass
+
+if datasize is None:
+    print('None of the files in {0} could be read'.format(args.pathfile))
+    sys.exit(1)
+
+store = rpreddtypes.RpPreparedStore()
+store.create(args.output, seqnos[0], seqnos[-1], datasize)
+
+nFailed = 0
+for seqno in seqnos:
+    try:
+        data = rpreddtypes.readPreparedData(pathmap[seqno])
+    except (OSError, rpreddtypes.RpBinFileReadError) as ex:
+        print('Skipping {0}:  {1}'.format(pathmap[seqno], ex))
+        nFailed += 1
+        continue
+
+    if len(data) != datasize:
+        print('Skipping {0}:  prepared data is {1} bytes, expected {2}'
+              .format(pathmap[seqno], len(data), datasize))
+        nFailed += 1
+        continue
+
+    store.setFrame(seqno, data)
+
+store.close()
+
+if args.verbose:
+    print('Wrote {0} frames covering sequence numbers {1} to {2} '
+          'into {3}'.format(len(seqnos) - nFailed, seqnos[0], seqnos[-1],
+                            args.output))
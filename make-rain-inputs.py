@@ -8,15 +8,152 @@
 import argparse
 import sys
 import os
+import multiprocessing
 import gif
 import rpreddtypes
-from rpreddtypes import normalize
 import numpy
-import math
 
 
 
 
+class ConversionError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+def convertFile(ifile):
+    """
+    Converts one radar .gif file to an intermediate binary file.
+    Returns a message to report, or None, and the file's frame index
+    entry, (seqno, path, totalRain, maxval), or None.  Uses the
+    baseline, mask and module map set up at startup, which worker
+    processes inherit when they are forked.
+    """
+
+    if os.path.getsize(ifile) == 0:
+        return 'Skipping zero length file: {}'.format(ifile), None
+    
+    convertReader = gif.Reader()
+    cfile = open(ifile, 'rb')
+    convertReader.feed(cfile.read())
+    cfile.close()
+
+    totalRain = 0
+    imgoffset = 0
+    valid = False
+    
+    if ( not convertReader.is_complete()
+         or not convertReader.has_screen_descriptor() ):
+        raise ConversionError('Failed to parse {0} as a '
+                              '.gif file'.format(ifile))
+
+    if ( len(convertReader.blocks) == 2
+         and isinstance(convertReader.blocks[0], gif.Image)
+         and isinstance(convertReader.blocks[1], gif.Trailer)):
+
+        valid = True
+        imgoffset = 0
+
+    if ( len(convertReader.blocks) == 3
+         and isinstance(convertReader.blocks[0], gif.GraphicControlExtension)
+         and isinstance(convertReader.blocks[1], gif.Image)
+         and isinstance(convertReader.blocks[2], gif.Trailer)):
+
+        valid = True
+        imgoffset = 1
+    
+
+    if not valid:
+        raise ConversionError("While processing file {0}:  "
+                              "The code only accepts input files with a "
+                              "single block of type Image followed by one "
+                              "of type Trailer, and optionally a graphic "
+                              "control extension block before the image "
+                              "block.  This constraint has not been met, "
+                              "the code will have to be changed to handle "
+                              "the more complicated case.  "
+                              "blocks: {1}".format(ifile,
+                                                   convertReader.blocks))
+
+        
+    convertBuffer = convertReader.blocks[imgoffset].get_pixels()
+    convertColours = convertReader.color_table
+    convertWidth = convertReader.width
+    convertHeight = convertReader.height
+
+    if baselineWidth != convertWidth or baselineHeight != convertHeight:
+        raise ConversionError('The baseline file ({0}) and the file to '
+                              'convert {1} have incompatible '
+                              'dimensions'.format(args.baseline, ifile))
+
+    # The lookup table only depends on the colour table, which is
+    # usually shared by the whole archive, so build it once per table.
+    tableKey = tuple(map(tuple, convertColours))
+    if tableKey not in intensityTables:
+        intensityTables[tableKey] = (
+            rpreddtypes.colourCodes(convertColours),
+            rpreddtypes.buildIntensityTable(convertColours,
+                                            args.intensities))
+    convertCodes, convertTable = intensityTables[tableKey]
+
+# First, compute the new output block.  We'll do preprocessing on that
+# once its complete
+    values, totalRain, present = rpreddtypes.convertRadarPixels(
+        baselineBuffer, baselineCodes, convertBuffer, convertCodes,
+        convertTable, baselineWidth, xoffset, yoffset,
+        newwidth, newheight, maskpixels)
+    output_block = bytearray(values)
+
+
+
+    preprocessed = None
+
+    if args.preproc:
+        # Pixels missing from the converted image do not count
+        # towards their module
+        modnums = numpy.where(present, pixelModules[:len(values)], -1)
+        preprocessed = rpreddtypes.aggregateModules(
+            modnums, values, numModules, args.heavy,
+            len(args.intensities), 5)
+
+
+    newfilename = ifile + '.bin'
+
+    writer = rpreddtypes.RpBinWriter()
+    writer.addRawdat(newwidth, newheight, xoffset, yoffset,
+                     len(args.intensities), output_block, [2, 3, 4])
+    writer.addPreparedData(len(preprocessed), args.numRings,
+                           args.numRadialCuts, preprocessed)
+    writer.write(newfilename, len(args.intensities), totalRain,
+                 args.binversion)
+
+    entry = None
+    seqno = rpreddtypes.computeSequenceNumber(ifile)
+    if seqno != -1:
+        entry = (seqno[0], os.path.abspath(newfilename), totalRain,
+                 len(args.intensities))
+
+    if (args.verbose):
+        return 'Wrote output file: {0}'.format(newfilename), entry
+    return None, entry
+
+
+def convertOrReport(ifile):
+    """
+    Wraps convertFile so that a failure on one file is reported
+    rather than aborting the batch.  Returns (failed, message, entry).
+    """
+    try:
+        message, entry = convertFile(ifile)
+        return False, message, entry
+    except ConversionError as ex:
+        return True, ex.message, None
+    except Exception as ex:
+        return True, ('While processing file {0}:  {1}'
+                      .format(ifile, ex)), None
+
+
+
 ### Main entry point starts here
 
 
@@ -78,9 +215,30 @@ parser.add_argument('--heavy', type=int, dest='heavy',
                     default = 3,
                     help = 'Intensity of heavy rain, for use when '
                     'producing pre--processed inputs.')
+parser.add_argument('--bin-version', type=int, dest='binversion',
+                    default = rpreddtypes.RpBinCommon.DEFAULT_VERSION,
+                    help = 'Version of the intermediate binary file '
+                    'format to write.')
+parser.add_argument('--no-module-cache', action='store_true',
+                    dest='nocache',
+                    help = 'Recompute the ring/sector module map '
+                    'rather than using the cached copy.')
 parser.add_argument('--verbose', type=bool, dest='verbose',
                     default = False,
                     help='Extra output during processing')
+parser.add_argument('--frame-index', type=str, dest='frameindex',
+                    help='If set, the frame index to which the '
+                    'sequence number, pathname, total rain and maxval '
+                    'of each converted file are added.  It is created '
+                    'if it does not exist.')
+parser.add_argument('--jobs', type=int, dest='jobs',
+                    default = 1,
+                    help='Number of worker processes converting files '
+                    'in parallel.')
+parser.add_argument('--chunk-size', type=int, dest='chunksize',
+                    default = 16,
+                    help='Number of files handed to a worker process '
+                    'at a time when --jobs is greater than 1.')
 
 args = parser.parse_args()
 
@@ -105,12 +263,14 @@ if args.mask:
     mfile = open(args.mask, 'rb')
     maskReader.feed(mfile.read())
     mfile.close()
-    maskpixels = maskReader.blocks[0].get_pixels()
+    maskpixels = numpy.asarray(maskReader.blocks[0].get_pixels())
 
-baselineBuffer = baselineReader.blocks[0].get_pixels()
+baselineBuffer = numpy.asarray(baselineReader.blocks[0].get_pixels())
 baselineColours = baselineReader.color_table
 baselineWidth = baselineReader.width
 baselineHeight = baselineReader.height
+baselineCodes = rpreddtypes.colourCodes(baselineColours)
+intensityTables = {}
 
 newwidth = baselineWidth
 if args.owidth != -1:
@@ -123,6 +283,7 @@ if args.oheight != -1:
 xoffset = args.offsetx
 yoffset = args.offsety
 modules = None
+pixelModules = None
 numModules = 0
 
 if args.preproc:
@@ -133,220 +294,60 @@ if args.preproc:
     # important consideration here.
 
     numModules = args.numRings * args.numRadialCuts
-    modules = numpy.full((newheight, newwidth), -1)
 
     # Modules are numbered clockwise (because this is a
     # left-handded coordinate system) from the X axis, closest
-    # ring first.
+    # ring first.  The map is cached on disk, see
+    # rpreddtypes.getModuleMap.
 
     radius = int(newwidth / 2)
-    r2 = radius ** 2
-    for pixelCol in range(2 * radius):
-        for pixelRow in range(2 * radius):
-            delta = [ pixelCol - radius, pixelRow - radius ]
-            d2 = delta[0] ** 2 + delta[1] ** 2
-            if d2 > r2:
-                continue
-
-            ringnum = int(math.sqrt(d2) / radius * args.numRings)
-            if ringnum >= args.numRings:
-                continue  # shouldn't happen for reasonable width floats
-
-            angle = math.atan2(delta[1], delta[0])
-            if angle < 0:
-                angle += 2 * math.pi
-
-            secnum = int(angle / (2 * math.pi) * args.numRadialCuts)
-
-            # More "shouldn't happen" floating point defense
-            if secnum < 0:
-                print('Found negative')
-                secnum = 0
-            if secnum >= args.numRadialCuts:
-                print('Found overflow')
-                secnum = args.numRadialCuts - 1
-
-            modnum = int(ringnum * args.numRadialCuts + secnum)
-            modules[pixelRow, pixelCol] = modnum
-
-
-for ifile in args.ifilenames:
-
-    if os.path.getsize(ifile) == 0:
-        print('Skipping zero length file: {}'.format(ifile))
-        continue
-    
-    convertReader = gif.Reader()
-    cfile = open(ifile, 'rb')
-    convertReader.feed(cfile.read())
-    cfile.close()
-
-    totalRain = 0
-    imgoffset = 0
-    valid = False
-    
-    if ( not convertReader.is_complete()
-         or not convertReader.has_screen_descriptor() ):
-        print ('Failed to parse {0} as a '
-               '.gif file'.format(ifile))
-        sys.exit(1)
-
-    if ( len(convertReader.blocks) == 2
-         and isinstance(convertReader.blocks[0], gif.Image)
-         and isinstance(convertReader.blocks[1], gif.Trailer)):
-
-        valid = True
-        imgoffset = 0
-
-    if ( len(convertReader.blocks) == 3
-         and isinstance(convertReader.blocks[0], gif.GraphicControlExtension)
-         and isinstance(convertReader.blocks[1], gif.Image)
-         and isinstance(convertReader.blocks[2], gif.Trailer)):
-
-        valid = True
-        imgoffset = 1
-    
-
-    if not valid:
-        print ("While processing file: ", sys.argv[i+1])
-        print ("The code only accepts input files with a single block of "
-               "type Image followed by one of type Trailer, and optionally "
-               "a graphic control extension block before the image block.  "
-               "This "
-               "constraint has not been met, the code will have to be "
-               "changed to handle the more complicated case.")
-
-        print('blocks: {}'.format(reader[i].blocks))
-        sys.exit(1)
-
-        
-    convertBuffer = convertReader.blocks[imgoffset].get_pixels()
-    convertColours = convertReader.color_table
-    convertWidth = convertReader.width
-    convertHeight = convertReader.height
-
-    if baselineWidth != convertWidth or baselineHeight != convertHeight:
-        print('The baseline file ({0}) and the file to convert {1} '
-              'have incompatible dimensions'.format(args.baseline,
-                                                    ifile))
-        sys.exit(1)
-
-    output_block = []
-
-# First, compute the new output block.  We'll do preprocessing on that
-# once its complete
-    for pixel in range(len(baselineBuffer)):
-
-        row = pixel // baselineWidth
-        col = pixel % baselineWidth
-
-        if row < yoffset:
-            continue
-
-        if row >= yoffset + newheight:
-            break
-
-        if col < xoffset or col >= xoffset + newwidth:
-            continue
-
-        if pixel >= len(convertBuffer):
-            output_block.append(0)
-            continue
-
-        if maskpixels and maskpixels[pixel] == 0:
-            output_block.append(0)
-            continue
-
-        btuple = baselineColours[baselineBuffer[pixel]]
-        ctuple = convertColours[convertBuffer[pixel]]
-        
-        if btuple == ctuple:
-            output_block.append(0)
-        else:
-            code = ( ctuple[0] * 256 * 256
-                     + ctuple[1] * 256
-                     + ctuple[2] )
-            appendval = 0
-            for i in range(len(args.intensities)):
-                if code == args.intensities[i]:
-                    appendval = i+1
-                    break
-            output_block.append(appendval)
-            totalRain += appendval
-
-
-
-    preprocessed = None
-    counts = None
-    nPixels = None
-    
-    if args.preproc:
-        nbytes = ( args.numRings * args.numRadialCuts * 3 )
-        preprocessed = bytearray(nbytes)
-
-        maxvals = [0] * numModules
-        counts = [0] * numModules
-        nPixels = [0] * numModules
-        sums = [0] * numModules
-        sums2 = [0] * numModules
-
-        for pixel in range(len(baselineBuffer)):
-
-            row = pixel // baselineWidth
-            col = pixel % baselineWidth
-
-            if row < yoffset:
-                continue
-
-            if row >= yoffset + newheight:
-                break
-
-            if col < xoffset or col >= xoffset + newwidth:
-                continue
-
-            if pixel >= len(convertBuffer):
-                continue
-
-            r1 = row - yoffset
-            c1 = col - xoffset
-            i1 = r1 * newwidth + c1
-            
-            modnum = modules[col][row]
-            if modnum == -1:
-                continue
-            
-            nPixels[modnum] += 1
-            if output_block[i1] != 0:
-                sums[modnum] += output_block[i1]
-                sums2[modnum] += output_block[i1] * output_block[i1]
-                counts[modnum] += 1
-
-
-        index = 0
-        for ring in range(args.numRings):
-            for sector in range(args.numRadialCuts):
-                modnum =  ring * args.numRadialCuts + sector
-                index = modnum * 3
-
-                if counts[modnum] == 0:
-                    preprocessed[index] = 0
-                    preprocessed[index+1] = 0
-                    preprocessed[index+2] = 0
-                else:
-                    preprocessed[index] = int(counts[modnum] / nPixels[modnum] * 255)
-                    preprocessed[index+1] = int(normalize(sums[modnum] / counts[modnum], args.heavy, len(args.intensities), 5) * 255)
-                    preprocessed[index+2] = int(normalize(math.sqrt(sums2[modnum] / counts[modnum]), args.heavy, len(args.intensities), 5) * 255)
-
-
-    newfilename = ifile + '.bin'
-
-    writer = rpreddtypes.RpBinWriter()
-    writer.addRawdat(newwidth, newheight, xoffset, yoffset,
-                     len(args.intensities), output_block, [2, 3, 4])
-    writer.addPreparedData(len(preprocessed), args.numRings,
-                           args.numRadialCuts, preprocessed)
-    writer.write(newfilename, len(args.intensities), totalRain)
-
-    if (args.verbose):
-        print('Wrote output file: {0}'.format(newfilename))
-
+    modules = rpreddtypes.getModuleMap(newwidth, newheight,
+                                       [radius, radius], args.numRings,
+                                       args.numRadialCuts,
+                                       useCache = not args.nocache)
+
+    # The module of each output pixel, in output order.  Note that
+    # the lookup has always been modules[col][row], transposed
+    # relative to the map itself.  The trained networks were built
+    # from data laid out this way, so it has to stay.
+    pixelModules = numpy.ascontiguousarray(
+        modules.T[yoffset:yoffset + newheight,
+                  xoffset:xoffset + newwidth]).ravel()
+
+
+nFailed = 0
+if args.jobs > 1:
+    # The fork start method lets the workers share the baseline, mask
+    # and module map computed above without re-sending them.
+    pool = multiprocessing.get_context('fork').Pool(args.jobs)
+    results = pool.imap(convertOrReport, args.ifilenames,
+                        chunksize = args.chunksize)
+else:
+    pool = None
+    results = map(convertOrReport, args.ifilenames)
+
+entries = []
+for failed, message, entry in results:
+    if failed:
+        nFailed += 1
+    if message:
+        print(message)
+    if entry:
+        entries.append(entry)
+
+if pool:
+    pool.close()
+    pool.join()
+
+if args.frameindex:
+    frameIndex = rpreddtypes.RpFrameIndex()
+    if os.path.exists(args.frameindex):
+        frameIndex.load(args.frameindex)
+    if entries:
+        frameIndex.update(*zip(*entries))
+    frameIndex.write(args.frameindex)
+
+if nFailed > 0:
+    print('Failed to convert {0} of {1} files'
+          .format(nFailed, len(args.ifilenames)))
+    sys.exit(1)
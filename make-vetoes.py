@@ -9,6 +9,7 @@
 import argparse
 import rpreddtypes
 import sys
+import numpy as np
 
 parser = argparse.ArgumentParser(description='Generate '
                                  'intensity data for plotting.')
@@ -23,6 +24,13 @@ parser.add_argument('--sequences', type=str,
                     help='A file of sequence information from '
                     'prepare-true-vals.py')
 
+parser.add_argument('--frame-index', type=str,
+                    dest='frameindex',
+                    help='A frame index written by make-rain-inputs.py.  '
+                    'If set, the total rain of each sequence number is '
+                    'taken from it rather than from the binary files '
+                    'named in --sequences.')
+
 parser.add_argument('--with-plotting-data', type=bool,
                     dest='plotdat', default=True,
                     help='Whether to generate plotting data '
@@ -54,22 +62,12 @@ if not args.candidates:
           '--candidates argument')
     sys.exit(1)
 
-if not args.sequences:
+if not args.sequences and not args.frameindex:
     print('A file with the list of sequence data be supplied with the '
-          '--sequences argument')
+          '--sequences argument, or a frame index with --frame-index')
     sys.exit(1)
 
-seqIntensity = {}
-sumIntensities = []
-with open(args.sequences, 'r') as ifile:
-    for record in ifile:
-        fields = record.split()
-        seqno = int(fields[0])
-        pathname = fields[1]
-        reader = rpreddtypes.RpBinReader()
-        reader.readHeader(pathname)
-        seqIntensity[seqno] = reader.getTotalRain()
-    
+startvals = []
 with open(args.candidates, 'r') as ifile:
     for record in ifile:
         fields = record.split()
@@ -83,13 +81,50 @@ with open(args.candidates, 'r') as ifile:
 
         if skipEntry:
             continue
-        
-        sum = 0
-        for i in range(6):
-            sum += seqIntensity[startval + i]
-
-        sumIntensities.append([sum, startval])
 
+        startvals.append(startval)
+
+# The total rain over the 6 historical timesteps of each candidate
+windows = np.asarray(startvals, dtype=np.int64)[:, None] + np.arange(6)
+
+if args.frameindex:
+    frameIndex = rpreddtypes.RpFrameIndex()
+    frameIndex.load(args.frameindex)
+    try:
+        totalRain = frameIndex.getTotalRain(windows)
+    except KeyError as ex:
+        print('Sequence number {0} is not in the frame index {1}'
+              .format(ex.args[0], args.frameindex))
+        sys.exit(1)
+
+    # Frames indexed without their header values, as by
+    # make-frame-index.py without --read-headers, are -1 and must be
+    # read from the binary files
+    unknown = totalRain < 0
+    if unknown.any():
+        seqIntensity = {}
+        for seqno in np.unique(windows[unknown]).tolist():
+            reader = rpreddtypes.RpBinReader()
+            reader.readHeader(frameIndex.getPath(seqno))
+            seqIntensity[seqno] = reader.getTotalRain()
+        totalRain[unknown] = [ seqIntensity[seqno]
+                               for seqno in windows[unknown].tolist() ]
+    sums = totalRain.sum(axis=1)
+else:
+    seqIntensity = {}
+    with open(args.sequences, 'r') as ifile:
+        for record in ifile:
+            fields = record.split()
+            seqno = int(fields[0])
+            pathname = fields[1]
+            reader = rpreddtypes.RpBinReader()
+            reader.readHeader(pathname)
+            seqIntensity[seqno] = reader.getTotalRain()
+    sums = [ sum(seqIntensity[seqno] for seqno in window)
+             for window in windows.tolist() ]
+
+sumIntensities = [ [ int(total), startval ]
+                   for total, startval in zip(sums, startvals) ]
 sumIntensities.sort()
 
 if args.plotdat:
@@ -113,11 +148,5 @@ if args.vetofile:
             ofile.write('{}\n'.format(v))
 
 if args.thinnedOutput:
-    with open(args.candidates, 'r') as ifile:
-        with open(args.thinnedOutput, "w") as ofile:
-            for record in ifile:
-                fields = record.split()
-                seqno = int(fields[0])
-                if seqno in vetoes:
-                    continue
-                ofile.write(record)
+    vetoSet = rpreddtypes.RpVetoSet(vetoes)
+    vetoSet.filterFile(args.candidates, args.thinnedOutput)
@@ -13,7 +13,6 @@ numRadialCuts = 20
 
 
 numModules = numRings * numRadialCuts
-modules = numpy.full((480, 480), -1)
 
 greyscale = []
 for i in range(256):
@@ -24,32 +23,8 @@ for i in range(256):
 # ring first.
 
 radius = int(480 / 2)
-r2 = radius ** 2
-for pixelCol in range(2 * radius):
-    for pixelRow in range(2 * radius):
-        delta = [ pixelCol - radius, pixelRow - radius ]
-        d2 = delta[0] ** 2 + delta[1] ** 2
-        if d2 > r2:
-            continue
-
-        ringnum = int(math.sqrt(d2) / radius * numRings)
-        if ringnum >= numRings:
-            continue  # shouldn't happen for reasonable width floats
-
-        angle = math.atan2(delta[1], delta[0])
-        if angle < 0:
-            angle += 2 * math.pi
-
-        secnum = int(angle / (2 * math.pi) * numRadialCuts)
-
-        # More "shouldn't happen" floating point defense
-        if secnum < 0:
-            secnum = 0
-        if secnum >= numRadialCuts:
-            secnum = numRadialCuts - 1
-
-        modnum = int(ringnum * numRadialCuts + secnum)
-        modules[pixelRow, pixelCol] = modnum
+modules = rpreddtypes.getModuleMap(480, 480, [radius, radius],
+                                   numRings, numRadialCuts)
 
 fileind = 0
 for arg in sys.argv[1:]:
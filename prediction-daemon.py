@@ -0,0 +1,79 @@
+#! /usr/bin/python3
+
+# Keeps the network loaded and serves the latest prediction on a Unix
+# socket, so that any number of desktop widgets can share one model
+# and one computation per timestep.  Configured from the same file as
+# deskwidget.py; set [Network] Daemon there to the socket pathname to
+# have the widget ask this daemon instead of loading the network.
+
+import argparse
+import configparser
+import os
+import sys
+import threading
+import keras
+import rpreddtypes
+import rplive
+
+
+parser = argparse.ArgumentParser(description='Serve rain predictions '
+                                 'to desktop widgets.')
+parser.add_argument('--config', type=str, dest='config',
+                    default=os.environ.get('RAIN_PREDICTOR_CONF',
+                                           '.rpwidget.conf'),
+                    help='The widget configuration file, for the '
+                    'network and data locations')
+parser.add_argument('--socket', type=str, dest='socket',
+                    help='The socket to listen on.  Defaults to the '
+                    '[Network] Daemon setting of the configuration.')
+parser.add_argument('--poll-seconds', type=int, dest='pollSeconds',
+                    default=30,
+                    help='How often to look for a new complete window '
+                    'of frames, at most, when no files change')
+parser.add_argument('--poll-files', action='store_true', dest='pollFiles',
+                    help='Check the data directories for new files by '
+                    'their modification times rather than with inotify')
+
+args = parser.parse_args()
+
+config = configparser.ConfigParser()
+config.read_file(open(args.config))
+if not config.sections():
+    print ('Unable to load configuration.')
+    sys.exit(1)
+
+savedNetwork = config.get('Network', 'SavedNetwork', fallback=None)
+computeDtype = config.get('Network', 'Dtype', fallback='float32')
+socketPath = args.socket or config.get('Network', 'Daemon', fallback=None)
+binFileFormatString = config.get('Data', 'BinFiles', fallback=None)
+frameIndexFile = config.get('Data', 'FrameIndex', fallback=None)
+lockfile = config.get('Data', 'LockFile', fallback=None)
+
+if not savedNetwork:
+    print('Need a saved network for producing predictions')
+    sys.exit(1)
+
+if not socketPath:
+    print('Need a socket to listen on')
+    sys.exit(1)
+
+if not binFileFormatString and not frameIndexFile:
+    print ('Need a bin file format string or a frame index to load data '
+           'for the predictions')
+    sys.exit(1)
+
+service = rplive.PredictionService(
+    keras.models.load_model(savedNetwork),
+    rpreddtypes.RpDtypePolicy(computeDtype),
+    rplive.LiveFrameSource(binFileFormatString, frameIndexFile, lockfile,
+                           watcher=rplive.FrameWatcher(args.pollFiles)))
+
+server = rplive.PredictionServer(socketPath, service)
+threading.Thread(target=service.run, args=(args.pollSeconds,),
+                 daemon=True).start()
+
+try:
+    server.serve_forever()
+finally:
+    server.server_close()
+    os.remove(socketPath)
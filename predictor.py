@@ -4,12 +4,82 @@
 
 
 import rpreddtypes
+import rpgenerator3
+import rplive
 import argparse
+import os
 import sys
+import time
 import numpy
 import keras
 
 
+class SequencePredictor:
+    """
+    Predicts single windows with a loaded network, reading only the
+    six prepared vectors each needs.  Consecutive requests share
+    frames through an rplive.FrameRing, and the pathfile is reread
+    when it changes, so new frames can be asked for as they arrive.
+    """
+
+    def __init__(self, model, policy, pathfile, length = 6):
+        self.model = model
+        self.policy = policy
+        self.pathfile = pathfile
+        self.length = length
+        self.ring = rplive.FrameRing(policy, length)
+        self.pathmap = None
+        self.pathStamp = None
+        self.reloadPaths()
+
+    def reloadPaths(self):
+        st = os.stat(self.pathfile)
+        stamp = (st.st_size, st.st_mtime_ns)
+        if stamp != self.pathStamp:
+            self.pathmap = rpreddtypes.openPathMap(self.pathfile)
+            self.pathStamp = stamp
+
+    def getPaths(self, seqno):
+        seqnos = range(seqno, seqno + self.length)
+        if not all(s in self.pathmap for s in seqnos):
+            self.reloadPaths()
+        missing = [ s for s in seqnos if s not in self.pathmap ]
+        if missing:
+            raise rpreddtypes.RpBinFileReadError('No file for sequence '
+                                                 'number {0}'
+                                                 .format(missing[0]))
+        return [ self.pathmap[s] for s in seqnos ]
+
+    def predict(self, seqno):
+        """
+        Returns the 10 outputs for the window starting at seqno
+        """
+        rawvals = self.ring.getWindow(seqno + self.length - 1,
+                                      self.getPaths(seqno))
+        month = rpreddtypes.sequenceNumberToDatetime(seqno).month
+        return rplive.predictWindow(self.model, self.policy, rawvals, month)
+
+
+def reportPrediction(predictor, request):
+    """
+    Prints the outputs for a sequence number, and the time taken from
+    receiving the request to having the result
+    """
+    start = time.perf_counter()
+    try:
+        seqno = int(request)
+        vals = predictor.predict(seqno)
+    except (ValueError, OSError, rpreddtypes.RpBinFileReadError) as ex:
+        print('{0} ERROR {1}'.format(request, ex), flush=True)
+        return False
+    elapsed = time.perf_counter() - start
+    print('{0} {1}  {2:.1f}ms'.format(seqno,
+                                      ' '.join('{0:.4f}'.format(val)
+                                               for val in vals),
+                                      elapsed * 1000), flush=True)
+    return True
+
+
 def histBinNum(val, nBins):
     if val >= 1:
         return nBins - 1
@@ -22,6 +92,8 @@ def histBinNum(val, nBins):
 
 errwts = [1, 0.7, 0.9, 0.6, 0.8, 0.5, 0.7, 0.4, 0.6, 0.3]
 
+batchSize = 512
+
 suffixes = [ '1H_R', '1H_HR', '2H_R', '2H_HR', '3H_R', '3H_HR',
              '4H_R', '4H_HR', '5H_R', '5H_HR' ]
              
@@ -32,7 +104,8 @@ parser = argparse.ArgumentParser(description='Make rain prediction(s).')
 parser.add_argument('--pathfile', type=str, dest='pathfile',
                     required = True,
                     help='The file that maps sequence numbers to '
-                    'the pathnames of the binary files.')
+                    'the pathnames of the binary files, the output of '
+                    'prepare-true-vals.py or a frame index.')
 parser.add_argument('--testdata', type=str, dest='candidates',
                     help='A candidates-style file with predictions.')
 parser.add_argument('--histograms', type=bool, dest='withHist',
@@ -49,37 +122,65 @@ parser.add_argument('--histogram-prefix', type=str, dest='histPrefix',
                     'histogram files.')
 parser.add_argument('--one-shot', type=int, dest='singleTest',
                     help='A sequence number for which to produce a '
-                    'prediction.')
+                    'prediction.  As in a candidates file, it is the '
+                    'first of the six timesteps.')
+parser.add_argument('--serve', action='store_true', dest='serve',
+                    help='Keep the network loaded and read sequence '
+                    'numbers from stdin, one per line, printing a '
+                    'prediction for each.')
 parser.add_argument('--saved-network', type=str, dest='savefile',
                     required = True,
                     help='The filename holding the complete saved '
                     'network (not just the weights).')
+parser.add_argument('--dtype', type=str, dest='dtype',
+                    default='float32',
+                    choices=sorted(rpreddtypes.RpDtypePolicy.COMPUTE_DTYPES),
+                    help='The floating point type in which inputs are '
+                    'handed to the network.')
 
 args = parser.parse_args()
 
+policy = rpreddtypes.RpDtypePolicy(args.dtype)
+
 if not args.pathfile:
     print('A pathfile is always required to connect sequence numbers '
           'to intermediate binary file pathnames.')
     sys.exit(1)
 
-if args.candidates and args.singleTest:
-    print('Only one of --testdata and --one-shot should be supplied')
+if [ bool(args.candidates), args.singleTest is not None,
+     args.serve ].count(True) > 1:
+    print('Only one of --testdata, --one-shot and --serve should be '
+          'supplied')
     sys.exit(1)
 
-if args.singleTest and args.withHist:
+if (args.singleTest is not None or args.serve) and args.withHist:
     print('It doesn\'t make sense to make a histogram of a single '
           'datapoint.')
     sys.exit(1)
 
 
-    
+loadStart = time.perf_counter()
+mymodel = keras.models.load_model(args.savefile)
 
-if args.singleTest:
-    print('Not yet implemented')
-    sys.exit(1)
 
+# Output lines are <SEQ_NO> <OUT_0> ... <OUT_9>  <LATENCY>ms
+# or <SEQ_NO> ERROR <MESSAGE>
 
-mymodel = keras.models.load_model(args.savefile)
+if args.singleTest is not None:
+    predictor = SequencePredictor(mymodel, policy, args.pathfile)
+    print('Network loaded in {0:.1f}ms'
+          .format((time.perf_counter() - loadStart) * 1000),
+          file=sys.stderr)
+    if not reportPrediction(predictor, str(args.singleTest)):
+        sys.exit(1)
+    sys.exit(0)
+
+if args.serve:
+    predictor = SequencePredictor(mymodel, policy, args.pathfile)
+    for request in sys.stdin:
+        if request.strip():
+            reportPrediction(predictor, request.strip())
+    sys.exit(0)
 
 hdata = None
 
@@ -90,14 +191,18 @@ if args.withHist:
 
 xvals = None
 yvals = None
+mvals = None
 datasize = None
 npts = None
 hashval = None
     
 if args.candidates:
-    xvals, yvals, datasize, npts, hashval = rpreddtypes.getDataVectors(args.candidates, args.pathfile, doShuffle = False)
+    xvals, yvals, mvals, datasize, npts, hashval = rpreddtypes.getDataVectors(args.candidates, args.pathfile, policy = policy)
 
-    ypred = mymodel.predict(x = xvals)
+    ypred = mymodel.predict(
+        x = rpgenerator3.RPArrayGenerator(xvals, mvals,
+                                          batch_size = batchSize,
+                                          policy = policy))
     errorMeasure = 0
 
     if args.withHist:
@@ -50,6 +50,7 @@ import os
 import rpreddtypes
 import numpy as np
 import math
+import multiprocessing
 import keras
 
 
@@ -103,72 +104,131 @@ def rotate_pixel_CCW (pixel, centre, nDiv, rotNum):
     cosT = np.cos(theta)
 
     # left-handed rotation matrix
-    rmat = np.array(((c, s), (-s, c)))
+    rmat = np.array(((cosT, sinT), (-sinT, cosT)))
     deltavec = np.array(delta)
     deltavec = rmat.dot(deltavec)
 
-    rval[0] = centre[0] + deltavec[0]
-    rval[1] = centre[1] + deltavec[1]
+    # Round back onto the pixel grid
+    rval[0] = int(round(centre[0] + deltavec[0]))
+    rval[1] = int(round(centre[1] + deltavec[1]))
     return rval
 
 
-def rainPresent(binReader, sensitivePixels, bounds, heavyVal, seqno):
+def rotationTable(centre, sensitivePixels, nRots):
     """
-    Returns a list of 2 integer elements.  The first indicates any
-    rain at all in any of the sensitive pixels.  The second indicates
-    rain above the threshold intensity for heavy rain.
+    Returns the sensitive pixels for the unrotated set and each of
+    the nRots rotations, as two [nRots + 1, nPixels] arrays of rows
+    and columns, so that the pixels of every set can be read from a
+    frame with one gather.
     """
+    sets = [ sensitivePixels ]
+    for rot in range(nRots):
+        sets.append([ rotate_pixel_CCW(list(pixel), centre, nRots + 1,
+                                       rot + 1)
+                      for pixel in sensitivePixels ])
+    table = np.array(sets, dtype=np.int64)
+    return table[:, :, 0], table[:, :, 1]
 
-    rpbo = binReader.getScaledObject(1)
-    mrv = binReader.getMaxRainval()
-    maxSeen = 0
-    anyRain = 0
-    heavyRain = 0
-    checkPhantom = True
+
+def rainPresent(data, xoffset, yoffset, rows, cols, heavyVal):
+    """
+    Evaluates every set of sensitive pixels in the rotation table
+    at once.  Returns a list holding, for each set, a list of 2
+    integer elements, and a list of flags.  The first element
+    indicates any rain at all in any of the sensitive pixels.  The
+    second indicates rain above the threshold intensity for heavy
+    rain.  Where the flag is True, the only rain seen is light
+    enough that it may be phantom rain, and the result stands only
+    if the phantom rain network says it is not.
+    """
+    maxSeen = data[rows - yoffset, cols - xoffset].max(axis=1)
+
+    heavyRain = maxSeen >= heavyVal
+    anyRain = heavyRain | (maxSeen > 0)
+    checkPhantom = anyRain & ~heavyRain & (maxSeen <= 1)
+
+    truevals = np.stack([ anyRain, heavyRain ], axis=1).astype(int)
+    return truevals.tolist(), checkPhantom.tolist()
+
+
+def phantomClip(data, bounds):
+    """
+    Returns the region of the data that the phantom rain network
+    examines.  The bounds are [minCol, maxCol, minRow, maxRow].
+    """
+    return np.array(data[bounds[2]:bounds[3] + 1, bounds[0]:bounds[1] + 1])
+
+
+def findPhantoms(clips, maxvals, batchSize):
+    """
+    Runs the phantom rain network over all the clips, in batches of
+    batchSize.  Returns a boolean array, True where the rain in the
+    clip is phantom.
+    """
+    isPhantom = np.zeros(len(clips), dtype=bool)
+    for start in range(0, len(clips), batchSize):
+        stop = min(start + batchSize, len(clips))
+        batch = np.stack(clips[start:stop])[:, np.newaxis]
+        scale = np.asarray(maxvals[start:stop],
+                           dtype=np.float64)[:, None, None, None]
+        batch = (batch / scale - 0.5) * 2
+        predictions = phantomRainNetwork.predict(x = batch,
+                                                 batch_size = batchSize)
+        predictions = predictions.reshape(len(batch), -1)
+        isPhantom[start:stop] = predictions[:, 0] >= 0.5
+    return isPhantom
+
+
+def examineFile(inputfile):
+    """
+    Reads one file and evaluates every set of sensitive pixels.
+    Returns (seqno, record, truevals, phantomSets, clip, maxval).
+    phantomSets lists the indices into truevals that stand only if
+    the phantom rain network passes the clip, clip and maxval are
+    None if there are none.
+    """
+    rpReader = rpreddtypes.RpBinReader()
+    rpReader.read(inputfile, lazy = True)
+    seqno, junk1, junk2, junk3, junk4, junk5 = rpreddtypes.computeSequenceNumber(inputfile)
+
+    record = '{0} {1} {2} {3}'.format(seqno, os.path.abspath(inputfile),
+                                      hashString, args.rotations)
+
+    rpbo = rpReader.getScaledObject(1)
+    data = rpbo.getNumpyArrayMax()
     xoffset = rpbo.getXOffset()
     yoffset = rpbo.getYOffset()
-    offset = [yoffset, xoffset]
-    dataWidth = rpbo.getWidth()
-    dataHeight = rpbo.getHeight()
-    data = rpbo.getNumpyArrayMax()
-    
-    for pixel in sensitivePixels:
-        pval = data[pixel[0] - yoffset][pixel[1] - xoffset]
-        if pval > 0:
-            anyRain = 1
-            if pval > 1:
-                checkPhantom = False
-            if pval >= maxSeen:
-                maxSeen = pval
-        if maxSeen >= heavyVal:
-            heavyRain = 1
-            return [ 1, 1 ]
-
-    if not anyRain:
-        return [ 0, 0 ]
-
-    if not checkPhantom:
-        return [ anyRain, heavyRain ]
-
-    # Have to check for phantom rain.
-
-    minRow = bounds[2]
-    minCol = bounds[0]
-    numRows = bounds[3] - bounds[2] + 1
-    numCols = bounds[1] - bounds[0] + 1
-
-    clipped = np.zeros((1, 1, numRows, numCols))
-    for row in range(numRows):
-        for col in range(numCols):
-            clipped[0, 0, row, col] = (data[minRow + row, minCol + col] / mrv - 0.5) * 2
-
-    isPhantom = phantomRainNetwork.predict(x = clipped)
-    if isPhantom[0] >= 0.5:
-        return [ 0, 0 ]
-    else:
-        return [ anyRain, heavyRain ]
-    
 
+    truevals, checkPhantom = rainPresent(data, xoffset, yoffset,
+                                         sensitiveRows, sensitiveCols,
+                                         args.heavy)
+    phantomSets = [ index for index in range(len(checkPhantom))
+                    if checkPhantom[index] ]
+
+    # The clip doesn't depend on the rotation, so is checked once per
+    # file
+    clip = None
+    maxval = None
+    if phantomSets:
+        clip = phantomClip(data, args.bounds)
+        maxval = rpReader.getMaxRainval()
+
+    return seqno, record, truevals, phantomSets, clip, maxval
+
+
+def flushPhantoms():
+    """
+    Classifies the held-back clips, and clears the rain values of
+    the files whose rain turns out to be phantom.
+    """
+    isPhantom = findPhantoms(pendingClips, pendingMaxvals, args.batchsize)
+    for index in isPhantom.nonzero()[0]:
+        truevals, phantomSets = pendingEntries[index]
+        for setIndex in phantomSets:
+            truevals[setIndex] = [ 0, 0 ]
+    pendingClips.clear()
+    pendingMaxvals.clear()
+    pendingEntries.clear()
 
 
 ## Main execution begins here
@@ -202,38 +262,66 @@ parser.add_argument('--heavy-rain-index', type=int, dest='heavy',
                     default=3, help='Lowest index in the colour table '
                     'that indicates heavy rain, where 1 is the '
                     'lightest rain.')
+parser.add_argument('--batch-size', type=int, dest='batchsize',
+                    default=1024, help='Number of clips passed to the '
+                    'phantom rain network at a time.')
+parser.add_argument('--jobs', type=int, dest='jobs',
+                    default=1, help='Number of worker processes '
+                    'reading files in parallel.')
+parser.add_argument('--chunk-size', type=int, dest='chunksize',
+                    default=16, help='Number of files handed to a '
+                    'worker process at a time when --jobs is greater '
+                    'than 1.')
 
 args = parser.parse_args()
 
 
-phantomRainNetwork = keras.models.load_model(args.phantomnet)
+hashString = rpreddtypes.genhash(args.centre, args.sensitive, args.heavy)
 
+sensitiveRows, sensitiveCols = rotationTable(args.centre, args.sensitive,
+                                             args.rotations)
 
-hashString = rpreddtypes.genhash(args.centre, args.sensitive, args.heavy)
+# Workers read the files and evaluate the sensitive pixels.  Results
+# that need the phantom rain network are held back, with their clips,
+# and the network is run in this process over a batch of them at a
+# time.  The workers are forked before the network is loaded, so that
+# they don't inherit it.
 
-for inputfile in args.ifilenames:
-    rpReader = rpreddtypes.RpBinReader()
-    rpReader.read(inputfile)
-    seqno, junk1, junk2, junk3, junk4, junk5 = rpreddtypes.computeSequenceNumber(inputfile)
+if args.jobs > 1:
+    pool = multiprocessing.get_context('fork').Pool(args.jobs)
+    results = pool.imap_unordered(examineFile, args.ifilenames,
+                                  chunksize = args.chunksize)
+else:
+    pool = None
+    results = map(examineFile, args.ifilenames)
 
-    record = '{0} {1} {2} {3}'.format(seqno,
-                                      os.path.abspath(inputfile),
-                                      rpreddtypes.genhash(args.centre,
-                                                          args.sensitive,
-                                                          args.heavy),
-                                      args.rotations)
-
-    truevals = rainPresent(rpReader, args.sensitive, args.bounds, args.heavy,
-                           seqno)
-    record = '{0} {1} {2}'.format(record, truevals[0], truevals[1])
-
-    for rot in range(args.rotations):
-        sense2 = args.sensitive.copy()
-        for i in range(len(sense2)):
-            sense2[i] = rotate_pixel_CCW(sense2[i], args.centre,
-                                         args.rotations + 1, rot + 1)
-        truevals = rainPresent(rpReader, sense2, args.bounds, args.heavy)
-        record = '{0} {1} {2}'.format(record, truevals[0], truevals[1])
+phantomRainNetwork = keras.models.load_model(args.phantomnet)
 
+outputs = []
+pendingClips = []
+pendingMaxvals = []
+pendingEntries = []
+
+for seqno, record, truevals, phantomSets, clip, maxval in results:
+    outputs.append((seqno, record, truevals))
+    if clip is not None:
+        pendingClips.append(clip)
+        pendingMaxvals.append(maxval)
+        pendingEntries.append((truevals, phantomSets))
+        if len(pendingClips) >= args.batchsize:
+            flushPhantoms()
+
+if pendingClips:
+    flushPhantoms()
+
+if pool:
+    pool.close()
+    pool.join()
+
+# Emit the records in sequence number order
+
+outputs.sort(key = lambda output: output[0])
+for seqno, record, truevals in outputs:
+    for vals in truevals:
+        record = '{0} {1} {2}'.format(record, vals[0], vals[1])
     print (record)
-        
@@ -0,0 +1,501 @@
+#! /usr/bin/python3
+
+# Brings the data preparation of DataPrep.txt up to date after new
+# radar images arrive, without reprocessing the whole archive.
+#
+# A manifest records every input each stage has already processed,
+# by path, size and modification time.  Only new or changed .gif
+# files are passed to make-rain-inputs.py, and only new or changed
+# .bin files to prepare-true-vals.py, whose records are merged into
+# the sequence file.  The prepared-data store is updated in place,
+# or grown to cover new sequence numbers.  Candidates are recomputed
+# only for the runs that can include a changed timestep, and merged
+# into the candidates file.
+#
+# The vetoes and the training/validation split depend on the whole
+# candidate list, so make-vetoes.py and datasplit.py are rerun
+# whenever the candidates change.
+#
+# With --frame-index, the index's pathnames and header values are
+# recorded by make-rain-inputs.py, and its labels and availability
+# are updated here from the new sequence file records.
+#
+# Manifest format, one line per processed input:
+# <STAGE> <SIZE> <MTIME_NS> <PATH>
+
+import argparse
+import bisect
+import os
+import subprocess
+import sys
+import tempfile
+import numpy as np
+import rpreddtypes
+
+
+# Sequence numbers spanned by one candidate, see get-training-set.py
+candidateLength = 36
+
+# Keep command lines well inside the system limit
+maxFilesPerRun = 1000
+
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+
+
+def statFile(path):
+    """
+    Returns (size, mtime_ns) for the file, or None if it is missing
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+def readManifest(filename):
+    """
+    Returns a dict mapping each stage to a dict of its processed
+    inputs, path -> (size, mtime_ns)
+    """
+    manifest = { 'GIF': {}, 'BIN': {} }
+    if not os.path.exists(filename):
+        return manifest
+    with open(filename, 'r') as ifile:
+        for record in ifile:
+            stage, size, mtime, path = record.rstrip('\n').split(' ', 3)
+            manifest.setdefault(stage, {})[path] = (int(size), int(mtime))
+    return manifest
+
+
+def replaceFile(filename, lines):
+    """
+    Writes the lines to a scratch file and renames it over filename,
+    so an interrupted refresh never leaves a truncated file.
+    """
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(
+        os.path.abspath(filename)))
+    with os.fdopen(fd, 'w') as ofile:
+        for line in lines:
+            ofile.write(line)
+    os.replace(tmpname, filename)
+
+
+def writeManifest(filename, manifest):
+    replaceFile(filename,
+                [ '{0} {1} {2} {3}\n'.format(stage, size, mtime, path)
+                  for stage in sorted(manifest)
+                  for path, (size, mtime) in sorted(manifest[stage].items()) ])
+
+
+def findChanged(entries, paths):
+    """
+    Returns the paths that are new, or whose size or modification
+    time differs from the recorded one
+    """
+    return [ path for path in paths if entries.get(path) != statFile(path) ]
+
+
+def findRemoved(entries):
+    return [ path for path in entries if not os.path.exists(path) ]
+
+
+def runScript(name, arglist, stdout = None):
+    if args.verbose:
+        print('Running {0} on {1} arguments'.format(name, len(arglist)))
+    return subprocess.run([ sys.executable, os.path.join(scriptDir, name) ]
+                          + arglist, stdout = stdout,
+                          universal_newlines = True)
+
+
+def readRecords(filename):
+    """
+    Reads a file whose records start with a sequence number, returns
+    a dict of seqno -> list of records for it
+    """
+    records = {}
+    if not os.path.exists(filename):
+        return records
+    with open(filename, 'r') as ifile:
+        for record in ifile:
+            fields = record.split()
+            if fields:
+                records.setdefault(int(fields[0]), []).append(record)
+    return records
+
+
+def mergeRecords(filename, records, newRecords, dropped):
+    """
+    Replaces the records of the dropped sequence numbers with
+    newRecords.  When there is nothing to replace and the new records
+    all follow the existing ones, they are appended to the file,
+    otherwise it is rewritten in sequence number order.
+    """
+    replaced = [ seqno for seqno in dropped if seqno in records ]
+    for seqno in replaced:
+        del records[seqno]
+
+    appendOnly = ( not replaced and
+                   ( not records or not newRecords or
+                     min(newRecords) > max(records) ) )
+    records.update(newRecords)
+
+    if appendOnly:
+        with open(filename, 'a') as ofile:
+            for seqno in sorted(newRecords):
+                for record in newRecords[seqno]:
+                    ofile.write(record)
+    else:
+        replaceFile(filename, [ record for seqno in sorted(records)
+                                for record in records[seqno] ])
+
+
+def convertGifs(gifs):
+    """
+    Runs make-rain-inputs.py over the gifs, returns those for which
+    a .bin file was written
+    """
+    # A stale .bin must not pass for a successful conversion
+    for gif in gifs:
+        if os.path.exists(gif + '.bin'):
+            os.remove(gif + '.bin')
+
+    options = [ '--baseline', args.baseline, '--jobs', str(args.jobs) ]
+    if args.mask:
+        options += [ '--mask', args.mask ]
+    if args.owidth != -1:
+        options += [ '--width', str(args.owidth) ]
+    if args.oheight != -1:
+        options += [ '--height', str(args.oheight) ]
+    if args.frameindex:
+        options += [ '--frame-index', args.frameindex ]
+
+    for start in range(0, len(gifs), maxFilesPerRun):
+        result = runScript('make-rain-inputs.py',
+                           options + gifs[start:start + maxFilesPerRun])
+        if result.returncode != 0:
+            # The files it did convert are still used, the rest are
+            # retried on the next run
+            print('make-rain-inputs.py failed on some files')
+
+    return [ gif for gif in gifs if os.path.exists(gif + '.bin') ]
+
+
+def computeTrueVals(bins):
+    """
+    Runs prepare-true-vals.py over the bins, returns a dict of
+    seqno -> [record] for those it produced a record for
+    """
+    options = [ '--phantom-network', args.phantomnet,
+                '--rotations', str(args.rotations),
+                '--jobs', str(args.jobs) ]
+    newRecords = {}
+    for start in range(0, len(bins), maxFilesPerRun):
+        result = runScript('prepare-true-vals.py',
+                           options + bins[start:start + maxFilesPerRun],
+                           stdout = subprocess.PIPE)
+        if result.returncode != 0:
+            print('prepare-true-vals.py failed, sequence file not updated')
+            sys.exit(1)
+        for record in result.stdout.splitlines(True):
+            fields = record.split()
+            if len(fields) > 4:
+                newRecords[int(fields[0])] = [ record ]
+    return newRecords
+
+
+def updateFrameIndex(indexfile, newRecords, removed):
+    """
+    Records the labels of the new sequence file records in the frame
+    index, as make-frame-index.py does, and marks the frames of the
+    removed sequence numbers unavailable.
+    """
+    frameIndex = rpreddtypes.RpFrameIndex()
+    if os.path.exists(indexfile):
+        frameIndex.load(indexfile)
+
+    seqnos = sorted(newRecords)
+    if seqnos:
+        fieldlists = [ newRecords[seqno][0].split() for seqno in seqnos ]
+        paths = [ fields[1] for fields in fieldlists ]
+        labels = [ list(map(int, fields[4:])) for fields in fieldlists ]
+        labelArray = np.full((len(labels), max(map(len, labels))), -1,
+                             dtype=np.int8)
+        for row in range(len(labels)):
+            labelArray[row, :len(labels[row])] = labels[row]
+        frameIndex.update(seqnos, paths = paths, labels = labelArray,
+                          available = [ os.path.exists(path)
+                                        for path in paths ])
+
+    gone = [ seqno for seqno in sorted(removed)
+             if frameIndex.hasSeqno(seqno) ]
+    if gone:
+        frameIndex.update(gone, available = False)
+
+    frameIndex.write(indexfile)
+
+
+def updateStore(storefile, pathmap, changed):
+    """
+    Writes the frames of the changed sequence numbers into the
+    store, growing it if they fall outside its range.
+    """
+    if not os.path.exists(storefile):
+        result = runScript('make-prepared-store.py',
+                           [ '--pathfile', args.sequences,
+                             '--output', storefile ])
+        if result.returncode != 0:
+            print('make-prepared-store.py failed, store not built')
+            sys.exit(1)
+        return
+
+    store = rpreddtypes.RpPreparedStore()
+    store.open(storefile, writable = True)
+    present = [ seqno for seqno in changed if seqno in pathmap ]
+    target = store
+    tmpname = None
+
+    if present and ( min(present) < store.getFirstSeqno() or
+                     max(present) > store.getLastSeqno() ):
+        # Slots are fixed when the store is created, so copy the
+        # frames already there into a larger one
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(
+            os.path.abspath(storefile)))
+        os.close(fd)
+        target = rpreddtypes.RpPreparedStore()
+        target.create(tmpname, min(present + [ store.getFirstSeqno() ]),
+                      max(present + [ store.getLastSeqno() ]),
+                      store.getDataSize())
+        for slot in store.getPresent().nonzero()[0]:
+            seqno = store.getFirstSeqno() + int(slot)
+            target.setFrame(seqno, store.getFrame(seqno))
+
+    for seqno in changed:
+        if seqno not in pathmap:
+            target.clearFrame(seqno)
+            continue
+        try:
+            data = rpreddtypes.readPreparedData(pathmap[seqno])
+        except (OSError, rpreddtypes.RpBinFileReadError) as ex:
+            print('Skipping {0}:  {1}'.format(pathmap[seqno], ex))
+            target.clearFrame(seqno)
+            continue
+        if len(data) != target.getDataSize():
+            print('Skipping {0}:  prepared data is {1} bytes, expected {2}'
+                  .format(pathmap[seqno], len(data), target.getDataSize()))
+            target.clearFrame(seqno)
+            continue
+        target.setFrame(seqno, data)
+
+    target.close()
+    if tmpname:
+        store.close()
+        os.replace(tmpname, storefile)
+
+
+def updateCandidates(tvsRecords, changed):
+    """
+    Recomputes the candidates whose run of sequence numbers includes
+    a changed one, and merges them into the candidates file.
+    """
+    # get-training-set.py only emits a run if there is a record after
+    # it, anywhere later in the file.  So adding or removing a
+    # sequence number can also decide whether the run ending at the
+    # record before it is emitted, however far back that is, and the
+    # subset handed to it must end with the first record past the
+    # window.
+    seqnos = sorted(tvsRecords)
+    affected = set()
+    window = set()
+    for seqno in changed:
+        affected.update(range(seqno - candidateLength, seqno + 1))
+        window.update(range(seqno - candidateLength,
+                            seqno + candidateLength + 1))
+        previous = bisect.bisect_left(seqnos, seqno) - 1
+        if previous >= 0:
+            runStart = seqnos[previous] - candidateLength + 1
+            affected.add(runStart)
+            window.update(range(runStart, seqnos[previous] + 1))
+
+    subset = sorted(window.intersection(tvsRecords))
+    if subset:
+        following = bisect.bisect_right(seqnos, subset[-1])
+        if following < len(seqnos):
+            subset.append(seqnos[following])
+
+    fd, subsetname = tempfile.mkstemp(suffix='.txt')
+    with os.fdopen(fd, 'w') as ofile:
+        for seqno in subset:
+            for record in tvsRecords[seqno]:
+                ofile.write(record)
+
+    result = runScript('get-training-set.py',
+                       [ subsetname, '--rotations', str(args.rotations) ],
+                       stdout = subprocess.PIPE)
+    os.remove(subsetname)
+    if result.returncode != 0:
+        print('get-training-set.py failed, candidates not updated')
+        sys.exit(1)
+
+    newRecords = {}
+    for record in result.stdout.splitlines(True):
+        fields = record.split()
+        if fields and int(fields[0]) in affected:
+            newRecords.setdefault(int(fields[0]), []).append(record)
+
+    existing = readRecords(args.candidates)
+    mergeRecords(args.candidates, existing, newRecords, affected)
+
+
+### Main entry point starts here
+
+
+parser = argparse.ArgumentParser(description='Incrementally refresh '
+                                 'the prepared training data.')
+parser.add_argument('ifilenames', type=str,
+                    metavar='filename', nargs='+',
+                    help='The radar .gif files, new and old')
+parser.add_argument('--manifest', type=str, dest='manifest',
+                    default='refresh-manifest.txt',
+                    help='The file recording the inputs already '
+                    'processed by each stage.')
+parser.add_argument('--baseline', type=str, dest='baseline',
+                    required=True,
+                    help='The baseline .gif file, passed to '
+                    'make-rain-inputs.py')
+parser.add_argument('--mask', type=str, dest='mask',
+                    help='The masking .gif file, passed to '
+                    'make-rain-inputs.py')
+parser.add_argument('--width', type=int, dest='owidth', default=-1,
+                    help='Passed to make-rain-inputs.py')
+parser.add_argument('--height', type=int, dest='oheight', default=-1,
+                    help='Passed to make-rain-inputs.py')
+parser.add_argument('--jobs', type=int, dest='jobs', default=1,
+                    help='Passed to make-rain-inputs.py and '
+                    'prepare-true-vals.py')
+parser.add_argument('--phantom-network', type=str, dest='phantomnet',
+                    required=True,
+                    help='Passed to prepare-true-vals.py')
+parser.add_argument('--rotations', type=int, dest='rotations',
+                    default=0,
+                    help='Passed to prepare-true-vals.py and '
+                    'get-training-set.py')
+parser.add_argument('--sequences', type=str, dest='sequences',
+                    default='tvs.txt',
+                    help='The sequence file written by '
+                    'prepare-true-vals.py')
+parser.add_argument('--frame-index', type=str, dest='frameindex',
+                    help='If set, the frame index to keep up to date.  '
+                    'It is read by make-vetoes.py.')
+parser.add_argument('--store', type=str, dest='store',
+                    help='If set, the prepared-data store to keep '
+                    'up to date.')
+parser.add_argument('--candidates', type=str, dest='candidates',
+                    default='candidates.txt',
+                    help='The candidates file written by '
+                    'get-training-set.py')
+parser.add_argument('--thinned', type=str, dest='thinned',
+                    default='thinned.txt',
+                    help='The thinned candidates written by '
+                    'make-vetoes.py')
+parser.add_argument('--training-file', type=str, dest='trainingFile',
+                    default='training.txt',
+                    help='The training set written by datasplit.py')
+parser.add_argument('--validation-file', type=str, dest='validationFile',
+                    default='holdout.txt',
+                    help='The validation set written by datasplit.py')
+parser.add_argument('--verbose', type=bool, dest='verbose',
+                    default = False,
+                    help='Extra output during processing')
+
+args = parser.parse_args()
+
+manifest = readManifest(args.manifest)
+gifEntries = manifest['GIF']
+binEntries = manifest['BIN']
+
+# Stage 1, make-rain-inputs.py
+
+for gif in findRemoved(gifEntries):
+    del gifEntries[gif]
+
+gifs = [ os.path.abspath(gif) for gif in args.ifilenames ]
+changedGifs = findChanged(gifEntries, gifs)
+if changedGifs:
+    for gif in convertGifs(changedGifs):
+        gifEntries[gif] = statFile(gif)
+    writeManifest(args.manifest, manifest)
+
+# Stage 2, prepare-true-vals.py
+
+bins = [ gif + '.bin' for gif in sorted(gifEntries)
+         if os.path.exists(gif + '.bin') ]
+changedBins = findChanged(binEntries, bins)
+removedBins = findRemoved(binEntries)
+
+if not changedBins and not removedBins:
+    if args.verbose:
+        print('Nothing to do')
+    sys.exit(0)
+
+tvsRecords = readRecords(args.sequences)
+newRecords = computeTrueVals(changedBins)
+
+changed = set(newRecords)
+for binfile in removedBins:
+    seqno = rpreddtypes.computeSequenceNumber(binfile)
+    if seqno != -1:
+        changed.add(seqno[0])
+
+mergeRecords(args.sequences, tvsRecords, newRecords, changed)
+
+if args.verbose:
+    print('{0} sequence numbers added or changed, {1} removed'
+          .format(len(newRecords), len(changed) - len(newRecords)))
+
+if args.frameindex:
+    updateFrameIndex(args.frameindex, newRecords,
+                     changed.difference(newRecords))
+
+# Stage 3, the prepared-data store
+
+if args.store and changed:
+    updateStore(args.store, { seqno: records[0].split()[1]
+                              for seqno, records in tvsRecords.items() },
+                changed)
+
+# Stage 4, get-training-set.py, make-vetoes.py and datasplit.py
+
+if changed:
+    updateCandidates(tvsRecords, changed)
+
+    vetoOptions = [ '--write-thinned-data', args.thinned,
+                    '--candidates', args.candidates,
+                    '--sequences', args.sequences ]
+    if args.frameindex:
+        vetoOptions += [ '--frame-index', args.frameindex ]
+    result = runScript('make-vetoes.py', vetoOptions,
+                       stdout = subprocess.DEVNULL)
+    if result.returncode != 0:
+        print('make-vetoes.py failed, thinned data not updated')
+        sys.exit(1)
+    result = runScript('datasplit.py',
+                       [ '--candidates', args.thinned,
+                         '--training-file', args.trainingFile,
+                         '--validation-file', args.validationFile ])
+    if result.returncode != 0:
+        print('datasplit.py failed, training and validation sets '
+              'not updated')
+        sys.exit(1)
+
+# Only now are the bins fully processed.  If anything above was
+# interrupted, the next run sees them as changed and redoes the work.
+
+for binfile in removedBins:
+    del binEntries[binfile]
+produced = set(records[0].split()[1] for records in newRecords.values())
+for binfile in changedBins:
+    if binfile in produced:
+        binEntries[binfile] = statFile(binfile)
+
+writeManifest(args.manifest, manifest)
@@ -40,11 +40,7 @@ class RPDataGenerator(keras.utils.Sequence):
         self.loadFromFiles()
 
     def loadFromFiles(self):
-        with open(self.path_file, 'r') as ifile:
-            for record in ifile:
-                fields = record.split()
-                seqno = int(fields[0])
-                self.pathmap[seqno] = fields[1]
+        self.pathmap = rpreddtypes.openPathMap(self.path_file)
 
         vetolist = []
         if self.veto_file:
@@ -48,11 +48,7 @@ class RPDataGenerator2(keras.utils.Sequence):
         self.loadFromFiles()
 
     def loadFromFiles(self):
-        with open(self.path_file, 'r') as ifile:
-            for record in ifile:
-                fields = record.split()
-                seqno = int(fields[0])
-                self.pathmap[seqno] = fields[1]
+        self.pathmap = rpreddtypes.openPathMap(self.path_file)
 
         vetolist = []
         if self.veto_file:
@@ -106,7 +102,7 @@ class RPDataGenerator2(keras.utils.Sequence):
 
     def inputsFromOneFile(self, filename):
         reader = rpreddtypes.RpBinReader()
-        reader.read(filename)
+        reader.read(filename, lazy = True)
         if not self.num_intensities:
             self.num_intensities = reader.getMaxRainval()
 
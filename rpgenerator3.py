@@ -0,0 +1,128 @@
+#! /usr/bin/python3
+
+# A streaming data generator for rptrainer2.py, after the idea of
+# the obsolete RPDataGenerator2.  Every frame the candidates need is
+# decoded once, up front, into an in-memory uint8 frame table (or
+# memory-mapped from a prepared-data store).  Batches are gathered
+# from that table and scaled to floating point as they are needed,
+# with the next few prepared on background threads while the network
+# trains on the current one.
+
+import keras
+import rpreddtypes
+import math
+import numpy
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class RPDataGenerator3(keras.utils.Sequence):
+    'Streams batches of candidates from a frame table'
+
+    def __init__(self, sequence_file, path_file = None, store = None,
+                 batch_size = 512, shuffle = True, prefetch = 2,
+                 policy = None):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.prefetch = prefetch
+        self.loader = rpreddtypes.RpWindowLoader(policy = policy)
+        self.loader.loadCandidates(sequence_file, path_file, store)
+        self.order = numpy.arange(self.loader.getNumWindows())
+
+        self.mutex = threading.Lock()
+        self.pending = {}
+        self.executor = None
+        if self.prefetch > 0:
+            self.executor = ThreadPoolExecutor(max_workers = self.prefetch)
+
+        if self.shuffle:
+            self.shuffleSequence()
+
+    def shuffleSequence(self):
+        numpy.random.shuffle(self.order)
+
+    def on_epoch_end(self):
+        # Prefetched batches were built with the old order
+        with self.mutex:
+            pending = self.pending
+            self.pending = {}
+        for future in pending.values():
+            future.cancel()
+
+        if self.shuffle:
+            self.shuffleSequence()
+
+    def __len__(self):
+        return math.ceil(len(self.order) / self.batch_size)
+
+    def getBatchSize(self):
+        return self.batch_size
+
+    def getInputSize(self):
+        return self.loader.getDataSize()
+
+    def getNumCandidates(self):
+        return self.loader.getNumWindows()
+
+    def getHash(self):
+        return self.loader.computeHash()
+
+    def makeBatch(self, index):
+        # Sorting the batch makes the gather from the frame table
+        # walk forward through memory
+        indices = numpy.sort(self.order[index * self.batch_size:
+                                        (index + 1) * self.batch_size])
+        return ( [ self.loader.getX(indices), self.loader.getM(indices) ],
+                 self.loader.getY(indices) )
+
+    def __getitem__(self, index):
+        'Return one batch'
+        with self.mutex:
+            future = self.pending.pop(index, None)
+            if self.executor:
+                for ahead in range(index + 1,
+                                   min(index + 1 + self.prefetch, len(self))):
+                    if ahead not in self.pending:
+                        self.pending[ahead] = self.executor.submit(
+                            self.makeBatch, ahead)
+
+        if future and not future.cancelled():
+            return future.result()
+        return self.makeBatch(index)
+
+
+class RPArrayGenerator(keras.utils.Sequence):
+    'Serves batches of raw arrays already in memory, scaled per batch'
+
+    def __init__(self, xvals, mvals, yvals = None, batch_size = 512,
+                 shuffle = False, policy = None):
+        self.xvals = xvals
+        self.mvals = mvals
+        self.yvals = yvals
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.policy = policy if policy else rpreddtypes.RpDtypePolicy()
+        self.order = numpy.arange(len(xvals))
+
+        if self.shuffle:
+            self.shuffleSequence()
+
+    def shuffleSequence(self):
+        numpy.random.shuffle(self.order)
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.shuffleSequence()
+
+    def __len__(self):
+        return math.ceil(len(self.order) / self.batch_size)
+
+    def __getitem__(self, index):
+        'Return one batch, inputs only if there are no labels'
+        indices = numpy.sort(self.order[index * self.batch_size:
+                                        (index + 1) * self.batch_size])
+        inputs = [ self.policy.toCompute(self.xvals[indices]),
+                   self.mvals[indices] ]
+        if self.yvals is None:
+            return (inputs,)
+        return (inputs, self.policy.labels(self.yvals[indices]))
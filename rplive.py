@@ -0,0 +1,511 @@
+#! /usr/bin/python3
+
+# Live prediction support, shared by deskwidget.py and
+# prediction-daemon.py.
+#
+# The daemon keeps the network loaded, finds the most recent
+# complete window of six timesteps as new intermediate binary files
+# arrive, computes the 10 outputs once for each new window and
+# serves them to any number of clients over a local socket.
+#
+# Protocol, one line each way per request:
+# GET\n
+# answered with
+# RESULT <LAST_SEQ_NO> <OUT_0> ... <OUT_9>\n
+# or, before the first prediction has been made,
+# NONE\n
+
+import ctypes
+import ctypes.util
+import datetime
+import os
+import select
+import socket
+import socketserver
+import struct
+import threading
+import time
+import numpy as np
+import rpreddtypes
+
+def intervalStart(now):
+    """
+    Rounds a time down to the start of its 10-minute interval
+    """
+    return now.replace(minute = int(now.minute / 10) * 10,
+                       second = 0, microsecond = 0)
+
+
+def existingAncestor(path):
+    """
+    Returns the nearest directory at or above path that exists
+    """
+    path = os.path.abspath(path)
+    while not os.path.isdir(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+class FrameWatcher:
+    """
+    Reports changes to the entries of a set of directories.  Uses
+    inotify where the C library provides it, otherwise compares the
+    modification times of the directories on each check.
+    """
+
+    # From <sys/inotify.h>
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+
+    watchMask = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+                 | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+    eventHeader = struct.Struct('iIII')
+
+    def __init__(self, usePolling = False):
+        self.fd = None
+        self.libc = None
+        self.watches = {}      # directory -> watch descriptor, or mtime
+        if not usePolling:
+            self.openInotify()
+
+    def openInotify(self):
+        libname = ctypes.util.find_library('c')
+        if not libname:
+            return
+        try:
+            libc = ctypes.CDLL(libname, use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return
+        if fd >= 0:
+            self.libc = libc
+            self.fd = fd
+
+    def isPolling(self):
+        return self.fd is None
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.watches = {}
+
+    def dirStamp(self, directory):
+        try:
+            st = os.stat(directory)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime_ns)
+
+    def setDirectories(self, directories):
+        """
+        Watches exactly the given directories from now on
+        """
+        directories = set(directories)
+        for directory in list(self.watches):
+            if directory not in directories:
+                wd = self.watches.pop(directory)
+                if self.fd is not None:
+                    self.libc.inotify_rm_watch(self.fd, wd)
+
+        for directory in directories:
+            if directory in self.watches:
+                continue
+            if self.fd is None:
+                self.watches[directory] = self.dirStamp(directory)
+                continue
+            wd = self.libc.inotify_add_watch(self.fd,
+                                             os.fsencode(directory),
+                                             self.watchMask)
+            if wd >= 0:
+                self.watches[directory] = wd
+
+    def poll(self):
+        """
+        Returns True if anything changed since the last call, without
+        waiting
+        """
+        if self.fd is None:
+            changed = False
+            for directory in self.watches:
+                stamp = self.dirStamp(directory)
+                if stamp != self.watches[directory]:
+                    self.watches[directory] = stamp
+                    changed = True
+            return changed
+
+        changed = False
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return changed
+            changed = True
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, namelen = \
+                    self.eventHeader.unpack_from(buf, offset)
+                offset += self.eventHeader.size + namelen
+                if mask & self.IN_IGNORED:
+                    # The directory went away, so must be watched again
+                    for directory, watched in list(self.watches.items()):
+                        if watched == wd:
+                            del self.watches[directory]
+
+    def wait(self, timeout):
+        """
+        Waits up to timeout seconds for a change, which is left for
+        poll() to report
+        """
+        if self.fd is None:
+            time.sleep(timeout)
+        else:
+            select.select([self.fd], [], [], timeout)
+
+
+class LiveFrameSource:
+    """
+    Finds the intermediate binary files of the most recent complete
+    window of timesteps, either from a pathname format string with
+    YEAR, MONTH, DAY, HOUR and MIN fields, or from a frame index kept
+    current by make-rain-inputs.py --frame-index.
+
+    With a FrameWatcher, hasChanged() tells the caller when the window
+    may have changed, so that the files need not be looked for on
+    every check.
+    """
+
+    def __init__(self, binFormat = None, frameIndexFile = None,
+                 lockfile = None, length = 6, watcher = None,
+                 retries = 3):
+        self.binFormat = binFormat
+        self.frameIndexFile = frameIndexFile
+        self.lockfile = lockfile
+        self.length = length
+        self.retries = retries
+        self.frameIndex = None
+        self.frameIndexStamp = None
+        self.watcher = watcher
+        self.watchedNow = None
+
+    def isLocked(self):
+        return bool(self.lockfile) and os.path.exists(self.lockfile)
+
+    def refreshFrameIndex(self):
+        """
+        Reloads the frame index if it has been rewritten since it was
+        last loaded
+        """
+        try:
+            st = os.stat(self.frameIndexFile)
+        except OSError:
+            self.frameIndex = None
+            return
+        stamp = (st.st_size, st.st_mtime_ns)
+        if stamp != self.frameIndexStamp:
+            frameIndex = rpreddtypes.RpFrameIndex()
+            frameIndex.load(self.frameIndexFile)
+            self.frameIndex = frameIndex
+            self.frameIndexStamp = stamp
+
+    def findBinFile(self, dtime):
+        """
+        Returns the pathname of the binary file for a time, or None if
+        there isn't one yet
+        """
+        if self.frameIndexFile:
+            if not self.frameIndex:
+                return None
+            return self.frameIndex.get(
+                rpreddtypes.datetimeToSequenceNumber(dtime))
+
+        binName = self.binFormat.format(YEAR = dtime.year,
+                                        MONTH = dtime.month,
+                                        DAY = dtime.day,
+                                        HOUR = dtime.hour,
+                                        MIN = dtime.minute)
+        if not os.path.exists(binName):
+            return None
+        return binName
+
+    def watchDirectories(self, now):
+        """
+        Watches the directories in which the files for windows ending
+        near now will appear, or their nearest existing ancestors if
+        they haven't been made yet
+        """
+        directories = set()
+        if self.lockfile:
+            directories.add(existingAncestor(os.path.dirname(self.lockfile)))
+        if self.frameIndexFile:
+            directories.add(existingAncestor(
+                os.path.dirname(self.frameIndexFile)))
+        else:
+            for step in range(-1, self.retries + self.length - 1):
+                dtime = now - datetime.timedelta(0, 600 * step)
+                binName = self.binFormat.format(YEAR = dtime.year,
+                                                MONTH = dtime.month,
+                                                DAY = dtime.day,
+                                                HOUR = dtime.hour,
+                                                MIN = dtime.minute)
+                directories.add(existingAncestor(os.path.dirname(binName)))
+        self.watcher.setDirectories(directories)
+
+    def hasChanged(self, now = None):
+        """
+        Returns True if the latest window may be different from when
+        this was last called.  Always True without a watcher.
+        """
+        if not self.watcher:
+            return True
+        if now is None:
+            now = datetime.datetime.utcnow()
+        now = intervalStart(now)
+
+        if now != self.watchedNow:
+            self.watchedNow = now
+            self.watchDirectories(now)
+            self.watcher.poll()
+            return True
+
+        if not self.watcher.poll():
+            return False
+        # Directories may have been made for the files we wait for
+        self.watchDirectories(now)
+        return True
+
+    def invalidate(self):
+        """
+        Makes the next hasChanged() return True, to retry after a
+        failure
+        """
+        self.watchedNow = None
+
+    def findLatestWindow(self, now = None):
+        """
+        Returns (dtimes, paths) for the latest complete window ending
+        in one of the last few 10 minute intervals, oldest first, or
+        None if there isn't one or the data is locked.
+        """
+        if now is None:
+            now = datetime.datetime.utcnow()
+        now = intervalStart(now)
+
+        if self.isLocked():
+            return None
+
+        if self.frameIndexFile:
+            self.refreshFrameIndex()
+
+        for retry in range(self.retries):
+            dtimes = [ now - datetime.timedelta(0, 600 * (retry + self.length
+                                                          - 1 - inum))
+                       for inum in range(self.length) ]
+            paths = []
+            for dtime in dtimes:
+                path = self.findBinFile(dtime)
+                if not path:
+                    break
+                paths.append(path)
+            if len(paths) == self.length:
+                return dtimes, paths
+
+        return None
+
+
+class FrameRing:
+    """
+    The prepared data of the latest window of consecutive timesteps.
+    Moving the window on shifts the frames already held and reads
+    only the files of the new timesteps, so in steady state one file
+    is read per 10 minutes.
+    """
+
+    def __init__(self, policy, length = 6):
+        self.policy = policy
+        self.length = length
+        self.frames = None
+        self.lastSeqno = None
+
+    def getWindow(self, lastSeqno, paths):
+        """
+        Returns the prepared data of the window of timesteps ending at
+        lastSeqno, as [1, length, datasize] in the storage dtype.
+        paths are the files of the window, oldest first.  The result
+        is only valid until the next call.
+        """
+        shift = self.length
+        if (self.lastSeqno is not None
+            and 0 <= lastSeqno - self.lastSeqno < self.length):
+            shift = lastSeqno - self.lastSeqno
+
+        # Forget the window while it is only partly loaded
+        self.lastSeqno = None
+        if shift == self.length:
+            self.frames = np.array([ rpreddtypes.readPreparedData(path)
+                                     for path in paths ],
+                                   dtype=self.policy.getStorageDtype())
+        elif shift:
+            self.frames[:-shift] = self.frames[shift:]
+            for timestep in range(self.length - shift, self.length):
+                self.frames[timestep] = rpreddtypes.readPreparedData(
+                    paths[timestep])
+        self.lastSeqno = lastSeqno
+        return self.frames[np.newaxis]
+
+
+def predictWindow(network, policy, rawvals, month):
+    """
+    Runs the network over a window of prepared data, [1, timesteps,
+    datasize] in the storage dtype.  month is that of the window's
+    first timestep, as in training.  Returns the 10 outputs.
+    """
+    mvals = np.empty([1, 1], dtype=policy.getComputeDtype())
+    mvals[0][0] = rpreddtypes.monthdata[month]
+    return network.predict([policy.toCompute(rawvals), mvals])[0]
+
+
+class PredictionService:
+    """
+    Keeps the latest prediction.  refresh() makes a new one only when
+    a new window of frames is complete.
+    """
+
+    def __init__(self, network, policy, source):
+        self.network = network
+        self.policy = policy
+        self.source = source
+        self.ring = FrameRing(policy, source.length)
+        self.mutex = threading.Lock()
+        self.result = None     # (last seqno, outputs)
+
+    def refresh(self, now = None):
+        """
+        Returns True if a new prediction was made
+        """
+        if not self.source.hasChanged(now):
+            return False
+        window = self.source.findLatestWindow(now)
+        if not window:
+            return False
+        dtimes, paths = window
+        lastSeqno = rpreddtypes.datetimeToSequenceNumber(dtimes[-1])
+
+        with self.mutex:
+            if self.result and self.result[0] == lastSeqno:
+                return False
+
+        rawvals = self.ring.getWindow(lastSeqno, paths)
+        vals = predictWindow(self.network, self.policy, rawvals,
+                             dtimes[0].month)
+        with self.mutex:
+            self.result = (lastSeqno, [ float(val) for val in vals ])
+        return True
+
+    def getResult(self):
+        with self.mutex:
+            return self.result
+
+    def run(self, pollSeconds = 30):
+        while True:
+            try:
+                self.refresh()
+            except Exception as ex:
+                print('Prediction failed:  {0}'.format(ex))
+                self.source.invalidate()
+            if self.source.watcher:
+                self.source.watcher.wait(pollSeconds)
+            else:
+                time.sleep(pollSeconds)
+
+
+def formatResult(result):
+    if not result:
+        return 'NONE\n'
+    return 'RESULT {0} {1}\n'.format(result[0],
+                                     ' '.join(map(repr, result[1])))
+
+
+def parseResult(line):
+    fields = line.split()
+    if not fields or fields[0] != 'RESULT':
+        return None
+    return int(fields[1]), list(map(float, fields[2:]))
+
+
+class PredictionRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if line.strip() != b'GET':
+                break
+            self.wfile.write(formatResult(self.server.service.getResult())
+                             .encode('ascii'))
+
+
+class PredictionServer(socketserver.ThreadingMixIn,
+                       socketserver.UnixStreamServer):
+    """
+    Serves the results of a PredictionService on a Unix socket
+    """
+    daemon_threads = True
+
+    def __init__(self, socketPath, service):
+        # A socket left behind by an earlier run
+        if os.path.exists(socketPath):
+            os.remove(socketPath)
+        self.service = service
+        socketserver.UnixStreamServer.__init__(self, socketPath,
+                                               PredictionRequestHandler)
+
+
+class PredictionClient:
+    """
+    Asks a prediction daemon for its latest result.  The connection is
+    kept open between requests, and remade if it fails.
+    """
+
+    def __init__(self, socketPath, timeout = 2.0):
+        self.socketPath = socketPath
+        self.timeout = timeout
+        self.sock = None
+        self.rfile = None
+
+    def close(self):
+        if self.rfile:
+            self.rfile.close()
+        if self.sock:
+            self.sock.close()
+        self.sock = None
+        self.rfile = None
+
+    def getPrediction(self):
+        """
+        Returns (last seqno, outputs), or None if the daemon has no
+        prediction or can't be reached
+        """
+        for attempt in range(2):
+            try:
+                if not self.sock:
+                    self.sock = socket.socket(socket.AF_UNIX,
+                                              socket.SOCK_STREAM)
+                    self.sock.settimeout(self.timeout)
+                    self.sock.connect(self.socketPath)
+                    self.rfile = self.sock.makefile('r')
+                self.sock.sendall(b'GET\n')
+                line = self.rfile.readline()
+                if line:
+                    return parseResult(line)
+            except OSError:
+                pass
+            self.close()
+        return None
@@ -2,6 +2,10 @@
 
 import numpy as np
 import gzip
+import zlib
+import os
+import tempfile
+import shutil
 import hashlib
 import abc
 import random
@@ -17,6 +21,17 @@ import datetime
 # MAXVAL <num>
 # TOTALRAIN <num>
 # <Binary blob of byte values>
+#
+# In version 4 the blob is a single gzip stream holding the
+# concatenated payloads.
+#
+# In version 5 the blob starts with a payload directory:  a 16-bit
+# count, then for each payload its magic number (16 bits), scaling
+# (16 bits, 0 for prepared data), offset (32 bits, from the end of
+# the directory), stored length (32 bits), decoded length (32 bits)
+# and codec (16 bits).  The payloads follow, each compressed
+# independently.  Prepared data comes first and is stored
+# uncompressed, so it can be read with a single seek and read.
 
 
 
@@ -39,6 +54,15 @@ class RpBinABC(metaclass = abc.ABCMeta):
         ba[index + 1] = value % 256
         return index + 2
 
+    def read32bitInt(ba, index):
+        high, index = RpBinABC.read16bitInt(ba, index)
+        low, index = RpBinABC.read16bitInt(ba, index)
+        return high * 65536 + low, index
+
+    def write32bitInt(value, ba, index):
+        index = RpBinABC.write16bitInt((value // 65536) % 65536, ba, index)
+        return RpBinABC.write16bitInt(value % 65536, ba, index)
+
     @abc.abstractmethod
     def readFromByteArray(self, ba, index):
         pass
@@ -50,6 +74,27 @@ class RpBinABC(metaclass = abc.ABCMeta):
     def peakMagicnum(ba, index):
         return RpBinABC.read16bitInt(ba, index)
 
+    # Enough bytes to hold the header of any payload type
+    payloadHeaderLength = 14
+
+    def peekPayloadExtent(ba, index):
+        """
+        Reads only the header of the payload at index.  Returns its
+        magic number, its scaling (None for prepared data) and its
+        total length in bytes.
+        """
+        mc, junk = RpBinABC.peakMagicnum(ba, index)
+        if mc == RpBinRawdat.rawdatMagicnum:
+            width, junk = RpBinABC.read16bitInt(ba, index + 4)
+            height, junk = RpBinABC.read16bitInt(ba, index + 6)
+            scaling, junk = RpBinABC.read16bitInt(ba, index + 12)
+            return mc, scaling, 7 * 2 + 2 * width * height
+        elif mc == RpBinPrepared.prepdatMagicnum:
+            datalength, junk = RpBinABC.read16bitInt(ba, index + 4)
+            return mc, None, 5 * 2 + datalength
+        else:
+            raise RpBinFileReadError('Unrecognized payload')
+
     def loadPayload(ba, index):
         mc, junk = RpBinABC.peakMagicnum(ba, index)
         if mc == RpBinRawdat.rawdatMagicnum:
@@ -146,8 +191,7 @@ class RpBinRawdat(RpBinABC):
         self.scaling = 1
         self.buffer = buffer
         self.avgbuff = bytearray(len(buffer))
-        for i in range(width * height):
-            self.avgbuff[i] = 255
+        self.avgbuff[0:width * height] = b'\xff' * (width * height)
 
         self.blen = len(buffer)
 
@@ -161,36 +205,32 @@ class RpBinRawdat(RpBinABC):
         rval.yoffset = self.yoffset
         rval.scaling = int(self.scaling * edgeScale)
         rval.blen = int(newWidth * newHeight)
-        rval.buffer = bytearray(rval.blen)
-        rval.avgbuff = bytearray(rval.blen)
-        for i in range(newWidth):
-            for j in range(newHeight):
-                indexC = j * newWidth + i
-                rval.buffer[indexC] = 0
-                rval.avgbuff[indexC] = 255
-                maxV = 0
-                sumV = 0
-                count = 0
-                for deltaX in range(edgeScale):
-                    for deltaY in range(edgeScale):
-                        ii = i * edgeScale + deltaX
-                        jj = j * edgeScale + deltaY
-                        indexF = jj * self.width + ii
-                        if ii < self.width and jj < self.height:
-                            sumV += self.buffer[indexF]
-                            count += 1
-                            if self.buffer[indexF] > maxV:
-                                maxV = self.buffer[indexF]
-
-                if count == 0:
-                    continue
-                
-                rval.buffer[indexC] = maxV
-                avgV = sumV / count
-                if maxV == 0:
-                    maxV = 1
-                    argV = 1
-                rval.avgbuff[indexC] = int(avgV / maxV * 255)
+
+        # Pad the image out to a whole number of tiles, then view it
+        # as [tileRow, deltaY, tileCol, deltaX].  The padding is zero,
+        # so it changes neither the maxima nor the sums, and we divide
+        # by the true number of pixels in each (possibly ragged) tile.
+        data = np.asarray(self.buffer, dtype=np.int64)
+        data = data[:self.width * self.height].reshape(self.height,
+                                                       self.width)
+        padded = np.zeros((newHeight * edgeScale, newWidth * edgeScale),
+                          dtype=np.int64)
+        padded[:self.height, :self.width] = data
+        tiles = padded.reshape(newHeight, edgeScale, newWidth, edgeScale)
+
+        maxV = tiles.max(axis=(1, 3))
+        sumV = tiles.sum(axis=(1, 3))
+        rowCounts = np.minimum(edgeScale,
+                               self.height - np.arange(newHeight) * edgeScale)
+        colCounts = np.minimum(edgeScale,
+                               self.width - np.arange(newWidth) * edgeScale)
+        count = np.outer(rowCounts, colCounts)
+
+        avgV = sumV / count
+        divisor = np.where(maxV == 0, 1, maxV)
+        rval.buffer = bytearray(maxV.astype(np.uint8).tobytes())
+        rval.avgbuff = bytearray((avgV / divisor * 255).astype(np.int64)
+                                 .astype(np.uint8).tobytes())
         return rval
 
 
@@ -266,7 +306,31 @@ class RpBinCommon:
     YOFFSET_KEY = 'YOFFSET'
     MAXVAL_KEY = 'MAXVAL'
     TOTALRAIN_KEY = 'TOTALRAIN'
-    
+
+    SUPPORTED_VERSIONS = [ 4, 5 ]
+    DEFAULT_VERSION = 5
+
+    # Version 5 payload directory
+    DIRENTRY_LENGTH = 18
+    CODEC_NONE = 0
+    CODEC_ZLIB = 1
+
+
+def encodePayload(data, codec):
+    if codec == RpBinCommon.CODEC_NONE:
+        return bytes(data)
+    elif codec == RpBinCommon.CODEC_ZLIB:
+        return zlib.compress(data)
+    raise RpBinFileReadError('Unrecognized codec {0}'.format(codec))
+
+
+def decodePayload(data, codec):
+    if codec == RpBinCommon.CODEC_NONE:
+        return bytearray(data)
+    elif codec == RpBinCommon.CODEC_ZLIB:
+        return bytearray(zlib.decompress(data))
+    raise RpBinFileReadError('Unrecognized codec {0}'.format(codec))
+
 
 class RpBinReader(RpBinCommon):
     """
@@ -279,19 +343,25 @@ class RpBinReader(RpBinCommon):
         self.numPayloads = -1
         self.payloads = []
         self.pathname = None
-
-    def read(self, filename):
-        self.readHeader(filename, True)
+        self.lazy = False
+
+    def read(self, filename, lazy = False):
+        """
+        Reads the file.  With lazy set, payloads are only decompressed
+        and decoded when they are asked for, see getScaledObject and
+        getPreparedDataObject.
+        """
+        self.readHeader(filename, True, lazy)
         
 
-    def readHeader(self, filename, withData = False):
+    def readHeader(self, filename, withData = False, lazy = False):
         self.pathname = filename
-        with open(filename, 'rb') as istream:
-            try:
-                istream = open(filename, 'rb')
-            except OSError as ex:
-                raise RpBinFileReadError(ex.strerror)
+        try:
+            istream = open(filename, 'rb')
+        except OSError as ex:
+            raise RpBinFileReadError(ex.strerror)
 
+        with istream:
             header = istream.readline().rstrip().decode('ascii')
             if header != self.HEADER_KEY:
                 raise RpBinFileReadError('File {0} is not a valid '
@@ -302,7 +372,8 @@ class RpBinReader(RpBinCommon):
             if vstr != self.VERSION_KEY:
                 raise RpBinFileReadError('File {0} is not a valid '
                                          'file'.format(filename))
-            if vnum != '4':
+            if ( not vnum.isdigit()
+                 or int(vnum) not in self.SUPPORTED_VERSIONS ):
                 raise RpBinFileReadError('File {0} is version {1} '
                                          'which is not supported'
                                          'by this code'.format(filename,
@@ -324,15 +395,137 @@ class RpBinReader(RpBinCommon):
                 raise RpBinFileReadError('File {0} is not a valid '
                                          'file'.format(filename))
 
-        if withData:
-            btmp1 = istream.read()
-            btmp2 = bytearray(gzip.decompress(btmp1))
-            nbytes = len(btmp2)
-            index = 0
-            while index < nbytes:
-                newobj, index = RpBinABC.loadPayload(btmp2, index)
-                self.payloads.append(newobj)
-            
+            if withData and self.version >= 5:
+                self.readDirectory(istream, lazy)
+            elif withData and lazy:
+                self.startLazyDecode(istream.read())
+            elif withData:
+                btmp1 = istream.read()
+                btmp2 = bytearray(gzip.decompress(btmp1))
+                nbytes = len(btmp2)
+                index = 0
+                while index < nbytes:
+                    newobj, index = RpBinABC.loadPayload(btmp2, index)
+                    self.payloads.append(newobj)
+
+    def readDirectory(self, istream, lazy):
+        """
+        Reads a version 5 payload directory.  When lazy, payloads are
+        left on disk and read individually on request, otherwise they
+        are all loaded now.
+        """
+        count, junk = RpBinABC.read16bitInt(istream.read(2), 0)
+        table = istream.read(count * self.DIRENTRY_LENGTH)
+        if len(table) != count * self.DIRENTRY_LENGTH:
+            raise RpBinFileReadError('Truncated payload directory in file '
+                                     '{0}'.format(self.pathname))
+        dataStart = istream.tell()
+
+        self.lazy = True
+        self.lazyIndex = []
+        self.lazyNext = None
+        index = 0
+        for i in range(count):
+            magic, index = RpBinABC.read16bitInt(table, index)
+            scaling, index = RpBinABC.read16bitInt(table, index)
+            offset, index = RpBinABC.read32bitInt(table, index)
+            length, index = RpBinABC.read32bitInt(table, index)
+            rawlength, index = RpBinABC.read32bitInt(table, index)
+            codec, index = RpBinABC.read16bitInt(table, index)
+            if magic == RpBinPrepared.prepdatMagicnum:
+                scaling = None
+            self.lazyIndex.append([magic, scaling, dataStart + offset,
+                                   dataStart + offset + length, None,
+                                   codec, rawlength])
+
+        if not lazy:
+            rest = istream.read()
+            for entry in self.lazyIndex:
+                data = rest[entry[2] - dataStart:entry[3] - dataStart]
+                self.decodeDirectoryPayload(entry, data)
+                self.payloads.append(entry[4])
+            self.lazy = False
+
+    def decodeDirectoryPayload(self, entry, data):
+        if len(data) != entry[3] - entry[2]:
+            raise RpBinFileReadError('Truncated payload in file '
+                                     '{0}'.format(self.pathname))
+        buffer = decodePayload(data, entry[5])
+        if len(buffer) != entry[6]:
+            raise RpBinFileReadError('Corrupt payload in file '
+                                     '{0}'.format(self.pathname))
+        entry[4], junk = RpBinABC.loadPayload(buffer, 0)
+        return entry[4]
+
+    # Lazy reading.  We keep the compressed data and inflate it
+    # incrementally, only as far as the furthest payload requested so
+    # far.  As we go we index each payload's type, scaling and extent
+    # from its header, and decode payload objects on first access.
+
+    lazyChunkSize = 65536
+
+    def startLazyDecode(self, compressed):
+        self.lazy = True
+        self.lazyInput = memoryview(compressed)
+        self.lazyInputPos = 0
+        self.lazyDecompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.lazyBuffer = bytearray()
+        self.lazyIndex = []      # [magic, scaling, start, end, object]
+        self.lazyNext = 0        # offset of the first unindexed payload
+
+    def decodeUpTo(self, nbytes):
+        """
+        Inflates until at least nbytes are available.  Returns False if
+        the data ends first.
+        """
+        while ( len(self.lazyBuffer) < nbytes
+                and self.lazyInputPos < len(self.lazyInput) ):
+            chunk = self.lazyInput[self.lazyInputPos:
+                                   self.lazyInputPos + self.lazyChunkSize]
+            self.lazyInputPos += len(chunk)
+            self.lazyBuffer += self.lazyDecompressor.decompress(chunk)
+        return len(self.lazyBuffer) >= nbytes
+
+    def indexNextPayload(self):
+        if self.lazyNext is None:
+            # Version 5 files index every payload up front
+            return None
+        if not self.decodeUpTo(self.lazyNext + 1):
+            return None
+        self.decodeUpTo(self.lazyNext + RpBinABC.payloadHeaderLength)
+        magic, scaling, length = RpBinABC.peekPayloadExtent(self.lazyBuffer,
+                                                            self.lazyNext)
+        entry = [magic, scaling, self.lazyNext, self.lazyNext + length, None]
+        self.lazyIndex.append(entry)
+        self.lazyNext += length
+        return entry
+
+    def decodeLazyPayload(self, entry):
+        if entry[4] is None and self.version >= 5:
+            with open(self.pathname, 'rb') as istream:
+                istream.seek(entry[2])
+                return self.decodeDirectoryPayload(
+                    entry, istream.read(entry[3] - entry[2]))
+
+        if entry[4] is None:
+            if not self.decodeUpTo(entry[3]):
+                raise RpBinFileReadError('Truncated payload in file '
+                                         '{0}'.format(self.pathname))
+            entry[4], junk = RpBinABC.loadPayload(self.lazyBuffer, entry[2])
+        return entry[4]
+
+    def findLazyPayload(self, magic, scaling):
+        for entry in self.lazyIndex:
+            if entry[0] == magic and entry[1] == scaling:
+                return self.decodeLazyPayload(entry)
+
+        while True:
+            entry = self.indexNextPayload()
+            if entry is None:
+                return None
+            if entry[0] == magic and entry[1] == scaling:
+                return self.decodeLazyPayload(entry)
+
 
     def getPathname(self):
         return self.pathname
@@ -362,6 +555,10 @@ class RpBinReader(RpBinCommon):
         return self.maxval
 
     def getScaledObject(self, edgeScaling):
+        if self.lazy:
+            return self.findLazyPayload(RpBinRawdat.rawdatMagicnum,
+                                        edgeScaling)
+
         for entry in self.payloads:
             if not isinstance(entry, RpBinRawdat):
                 continue
@@ -372,6 +569,9 @@ class RpBinReader(RpBinCommon):
         return None
 
     def getPreparedDataObject(self):
+        if self.lazy:
+            return self.findLazyPayload(RpBinPrepared.prepdatMagicnum, None)
+
         for entry in self.payloads:
             if isinstance(entry, RpBinPrepared):
                 return entry
@@ -402,24 +602,72 @@ class RpBinWriter(RpBinCommon):
         self.payloads.append(rppd)
 
         
-    def write(self, filename, maxval, totalRain):
+    def write(self, filename, maxval, totalRain, version = None):
+        if not version:
+            version = self.DEFAULT_VERSION
+        if version not in self.SUPPORTED_VERSIONS:
+            raise RpBinFileReadError('Cannot write file version '
+                                     '{0}'.format(version))
         self.pathname = filename
         with open(filename, 'wb') as ofile:
             ofile.write('{0}\n'.format(self.HEADER_KEY)
                         .encode('ascii'))
-            ofile.write('{0} {1}\n'.format(self.VERSION_KEY, 4)
+            ofile.write('{0} {1}\n'.format(self.VERSION_KEY, version)
                         .encode('ascii'))
             ofile.write('{0} {1}\n'.format(self.MAXVAL_KEY, maxval)
                         .encode('ascii'))
             ofile.write('{0} {1}\n'.format(self.TOTALRAIN_KEY, totalRain)
                         .encode('ascii'))
 
+            if version >= 5:
+                self.writeDirectory(ofile)
+                return
+
             ebuffer = bytearray()
             for obj in self.payloads:
                 ebuffer += obj.writeToByteArray()
 
             ofile.write(gzip.compress(ebuffer))
 
+    def writeDirectory(self, ofile):
+        """
+        Writes the version 5 payload directory and payloads.  Prepared
+        data goes first, uncompressed, the pixel data is compressed
+        one payload at a time.
+        """
+        ordered = ( [ obj for obj in self.payloads
+                      if isinstance(obj, RpBinPrepared) ]
+                    + [ obj for obj in self.payloads
+                        if not isinstance(obj, RpBinPrepared) ] )
+
+        table = bytearray(2 + len(ordered) * self.DIRENTRY_LENGTH)
+        index = RpBinABC.write16bitInt(len(ordered), table, 0)
+        blobs = []
+        offset = 0
+        for obj in ordered:
+            raw = obj.writeToByteArray()
+            if isinstance(obj, RpBinPrepared):
+                magic = RpBinPrepared.prepdatMagicnum
+                scaling = 0
+                codec = self.CODEC_NONE
+            else:
+                magic = RpBinRawdat.rawdatMagicnum
+                scaling = obj.getScaling()
+                codec = self.CODEC_ZLIB
+            blob = encodePayload(raw, codec)
+            index = RpBinABC.write16bitInt(magic, table, index)
+            index = RpBinABC.write16bitInt(scaling, table, index)
+            index = RpBinABC.write32bitInt(offset, table, index)
+            index = RpBinABC.write32bitInt(len(blob), table, index)
+            index = RpBinABC.write32bitInt(len(raw), table, index)
+            index = RpBinABC.write16bitInt(codec, table, index)
+            blobs.append(blob)
+            offset += len(blob)
+
+        ofile.write(table)
+        for blob in blobs:
+            ofile.write(blob)
+
 
 def genhash(centre, senseList, heavyThreshold, seed = 0xabcddcba):
     """
@@ -441,27 +689,88 @@ def genhash(centre, senseList, heavyThreshold, seed = 0xabcddcba):
     return hasher.digest().hex()[0:8]
 
 
-def getModNum(pixel, centre, numrings, numcuts):
-    radius = centre[0]
-    r2 = centre[0] ** 2 + centre[1] ** 2
-    delta = [ pixel[0] - centre[0], pixel[1] - centre[1] ]
-    d2 = delta[0] ** 2 + delta[1] ** 2
-    if d2 > r2:
-        return -1
-    ringIndex = int(math.sqrt(d2) / radius * numrings)
-    if ringIndex >= numrings:
-        return -1
-    angle = math.atan2(delta[1], delta[0])
-    if angle < 0:
-        angle += 2 * math.pi
+def computeModuleNumbers(xs, ys, centre, radius, numrings, numcuts):
+    """
+    Vectorized ring/sector module numbers for arrays of pixel
+    coordinates.  Modules are numbered clockwise (because this is a
+    left-handed coordinate system) from the X axis, closest ring
+    first.  Pixels outside the disc of the given radius get -1.
+    """
+    dx = np.asarray(xs, dtype=np.int64) - centre[0]
+    dy = np.asarray(ys, dtype=np.int64) - centre[1]
+    d2 = dx ** 2 + dy ** 2
+
+    ringIndex = (np.sqrt(d2) / radius * numrings).astype(np.int64)
+
+    angle = np.arctan2(dy, dx)
+    angle[angle < 0] += 2 * np.pi
+    secIndex = (angle / (2 * np.pi) * numcuts).astype(np.int64)
 
-    secIndex = int(angle / (2 * math.pi) * numcuts)
-    if secIndex < 0:
-        secIndex = 0
-    if secIndex >= numcuts:
-        secIndex = numcuts - 1
+    # "shouldn't happen" floating point defense
+    secIndex = np.clip(secIndex, 0, numcuts - 1)
 
-    return int(ringIndex * numcuts + secIndex)
+    rval = ringIndex * numcuts + secIndex
+    rval[(d2 > radius ** 2) | (ringIndex >= numrings)] = -1
+    return rval
+
+
+def getModuleCacheDir():
+    """
+    Returns the directory holding cached module maps, from the
+    RAIN_PREDICTOR_CACHE environment variable if set.
+    """
+    cachedir = os.environ.get('RAIN_PREDICTOR_CACHE')
+    if not cachedir:
+        cachedir = os.path.join(os.path.expanduser('~'), '.cache',
+                                'rain-predictor')
+    return cachedir
+
+
+def getModuleMap(width, height, centre, numrings, numcuts,
+                 cachedir = None, useCache = True):
+    """
+    Returns a [height, width] array holding the module number of
+    each pixel, indexed by [row, col], for a disc of radius centre[0]
+    about the centre.  The map is cached on disk keyed by its
+    parameters, so it is only ever computed once per geometry.
+    """
+    cachefile = None
+    if useCache:
+        if not cachedir:
+            cachedir = getModuleCacheDir()
+        cachefile = os.path.join(cachedir,
+                                 'modmap-{0}x{1}-c{2}_{3}-r{4}-s{5}.npy'
+                                 .format(width, height, centre[0],
+                                         centre[1], numrings, numcuts))
+        try:
+            rval = np.load(cachefile)
+            if rval.shape == (height, width):
+                return rval
+        except (OSError, ValueError):
+            pass
+
+    rows, cols = np.indices((height, width))
+    rval = computeModuleNumbers(cols, rows, centre, centre[0],
+                                numrings, numcuts).astype(np.int32)
+
+    if cachefile:
+        # Write to a scratch file and rename, so that concurrent
+        # batches never see a partial map
+        try:
+            os.makedirs(cachedir, exist_ok=True)
+            fd, tmpname = tempfile.mkstemp(dir=cachedir, suffix='.npy')
+            with os.fdopen(fd, 'wb') as ofile:
+                np.save(ofile, rval)
+            os.replace(tmpname, cachefile)
+        except OSError:
+            pass
+
+    return rval
+
+
+def getModNum(pixel, centre, numrings, numcuts):
+    return int(computeModuleNumbers([pixel[0]], [pixel[1]], centre,
+                                    centre[0], numrings, numcuts)[0])
 
 
 def normalize(val, heavy, num_intensities, intensity_gap):
@@ -472,6 +781,107 @@ def normalize(val, heavy, num_intensities, intensity_gap):
         return (intensity_gap + val) / nDivs
 
 
+def colourCodes(colours):
+    """
+    Returns a numpy array holding the 24-bit RGB code of each entry
+    in a .gif colour table, indexed by palette index.
+    """
+    table = np.asarray(colours, dtype=np.int64).reshape(-1, 3)
+    return table[:, 0] * 256 * 256 + table[:, 1] * 256 + table[:, 2]
+
+
+def buildIntensityTable(colours, intensities):
+    """
+    Returns a numpy array mapping each palette index of a .gif colour
+    table to a rain intensity.  Intensities count up from 1 in the
+    order of the intensities list, colours not in the list map to 0.
+    """
+    codes = colourCodes(colours)
+    rval = np.zeros(len(codes), dtype=np.uint8)
+    # Walk the list backwards so that the first match wins, as it
+    # does in a linear search
+    for i in reversed(range(len(intensities))):
+        rval[codes == intensities[i]] = i + 1
+    return rval
+
+
+def convertRadarPixels(baselineBuffer, baselineCodes,
+                       convertBuffer, convertCodes, convertTable,
+                       width, xoffset, yoffset, newwidth, newheight,
+                       maskpixels = None):
+    """
+    Converts the palette indices of a radar image into rain
+    intensities over the output sub-rectangle.  Pixels whose colour
+    matches the baseline, pixels masked out, and pixels missing from
+    the converted image are 0.
+
+    Returns the intensities as a flat uint8 array in row-major order,
+    the total rain, and a boolean array marking the pixels that were
+    present in the converted image.
+    """
+    baseline = np.asarray(baselineBuffer, dtype=np.intp)
+    converted = np.asarray(convertBuffer, dtype=np.intp)
+    npixels = len(baseline)
+    nrows = (npixels + width - 1) // width
+
+    rows = np.arange(yoffset, min(yoffset + newheight, nrows))
+    cols = np.arange(xoffset, min(xoffset + newwidth, width))
+    pixels = (rows[:, None] * width + cols[None, :]).ravel()
+    pixels = pixels[pixels < npixels]
+
+    present = pixels < len(converted)
+    indices = np.zeros(len(pixels), dtype=np.intp)
+    indices[present] = converted[pixels[present]]
+
+    values = convertTable[indices]
+    values[baselineCodes[baseline[pixels]] == convertCodes[indices]] = 0
+    values[~present] = 0
+    if maskpixels is not None and len(maskpixels) > 0:
+        values[np.asarray(maskpixels)[pixels] == 0] = 0
+
+    return values, int(values.sum(dtype=np.int64)), present
+
+
+def aggregateModules(modnums, values, numModules, heavy,
+                     num_intensities, intensity_gap = 5):
+    """
+    Builds the buffer for an RpBinPrepared payload.  modnums and
+    values are parallel arrays holding the module number (-1 to
+    ignore the pixel) and rain intensity of each pixel.  For each
+    module we emit three bytes:  the fraction of its pixels that
+    show rain, and the normalized mean and RMS of the rain
+    intensities, each scaled to 0-255.
+    """
+    modnums = np.asarray(modnums).ravel()
+    values = np.asarray(values).ravel()
+    inside = modnums >= 0
+    modnums = modnums[inside]
+    values = values[inside].astype(np.int64)
+
+    raining = values != 0
+    nPixels = np.bincount(modnums, minlength=numModules)
+    counts = np.bincount(modnums[raining], minlength=numModules)
+    sums = np.bincount(modnums, weights=values, minlength=numModules)
+    sums2 = np.bincount(modnums, weights=values * values,
+                        minlength=numModules)
+
+    hit = counts > 0
+    counts = counts[hit]
+    means = sums[hit] / counts
+    rms = np.sqrt(sums2[hit] / counts)
+
+    nDivs = num_intensities + intensity_gap
+    means = np.where(means < heavy, means / nDivs,
+                     (intensity_gap + means) / nDivs)
+    rms = np.where(rms < heavy, rms / nDivs, (intensity_gap + rms) / nDivs)
+
+    rval = np.zeros((numModules, 3), dtype=np.uint8)
+    rval[hit, 0] = (counts / nPixels[hit] * 255).astype(np.int64)
+    rval[hit, 1] = (means * 255).astype(np.int64)
+    rval[hit, 2] = (rms * 255).astype(np.int64)
+    return bytearray(rval.tobytes())
+
+
 def computeSequenceNumber(filename):
     """
     Returns a sequence number, or -1 on error
@@ -501,61 +911,938 @@ def computeSequenceNumber(filename):
 
     
 
-def getDataVectors(sequence_file, path_file):
+def loadPathMap(path_file):
+    """
+    Returns a dict mapping sequence numbers to the pathnames of the
+    intermediate binary files, from a file whose records start with
+    <SEQ_NO> <FULL_PATH>, such as the output of prepare-true-vals.py
+    """
     pathmap = {}
-    seqmap = {}
-    seqlist = []
     with open(path_file, 'r') as ifile:
         for record in ifile:
             fields = record.split()
             seqno = int(fields[0])
             pathmap[seqno] = fields[1]
+    return pathmap
+
+
+def openPathMap(path_file):
+    """
+    Returns the mapping from sequence numbers to the pathnames of the
+    intermediate binary files, from either a text file as read by
+    loadPathMap or an RpFrameIndex file.
+    """
+    with open(path_file, 'rb') as ifile:
+        magic = ifile.read(2)
+
+    # numpy.savez writes a zip archive
+    if magic == b'PK':
+        index = RpFrameIndex()
+        index.load(path_file)
+        return index
+    return loadPathMap(path_file)
 
-    with open(sequence_file, 'r') as ifile:
-        for record in ifile:
-            fields = record.split()
-            seqno = int(fields[0])
-            seqmap[seqno] = list(map(int, fields[5:]))
-            seqlist.append(seqno)
 
-    # Need to load the size of the data samples by loading one data
-    # file up front
-    probeseqno = seqlist[0]
-    probefilename = pathmap[seqno]
+def readPreparedData(filename):
+    """
+    Returns the prepared data of an intermediate binary file as a
+    uint8 numpy array, decoding nothing else.
+    """
     reader = RpBinReader()
-    reader.read(probefilename)
+    reader.read(filename, lazy = True)
     rpbo = reader.getPreparedDataObject()
-    datasize = rpbo.getDataLength()
-
-    rvalX = np.empty([len(seqlist), 6, datasize])
-    rvalY = np.empty([len(seqlist), 10])
-    rvalM = np.empty([len(seqlist), 1])   # month field
-
-    monthdata = [ None,
-                  0.16, 0, 0.16, 0.33, 0.5, 0.67,
-                  0.83, 1, 0.83, 0.67, 0.5, 0.33 ]
-
-    for index in range(len(seqlist)):
-        base_seqno = seqlist[index]
-        for timestep in range(6):
-            ts_seqno = base_seqno + timestep
-            ts_filename = pathmap[ts_seqno]
-            reader = RpBinReader()
-            reader.read(ts_filename)
-            rpbo = reader.getPreparedDataObject()
-            rvalX[index][timestep] = np.asarray(rpbo.getPreparedData()) / 255
-
-        rvalY[index] = np.asarray(seqmap[base_seqno])
-        junk1, junk2, month, junk3, junk4, junk5 = computeSequenceNumber(pathmap[base_seqno])
-        
-        rvalM[index] = monthdata[month]
+    if not rpbo:
+        raise RpBinFileReadError('File {0} has no prepared '
+                                 'data'.format(filename))
+    return np.frombuffer(bytes(rpbo.getPreparedData()), dtype=np.uint8)
+
+
+class RpPreparedStore:
+    """
+    All the prepared data vectors of an archive in one file, so they
+    can be memory-mapped rather than read from one .bin file per
+    timestep.  Frames are stored in slots, one per sequence number
+    from the first to the last, so a run of consecutive timesteps is
+    a contiguous slice.  A bitmap records which slots hold data,
+    missing slots are zero-filled.
+
+    Format:
+    RAIN PREDICTOR PREPARED STORE\n
+    VERSION 1\n
+    FIRSTSEQNO <num>\n
+    NUMSLOTS <num>\n
+    DATASIZE <num>\n
+    BITMAPOFFSET <num>\n
+    DATAOFFSET <num>\n
+    <bitmap, one bit per slot, padding>
+    <NUMSLOTS * DATASIZE bytes of frame data>
+    """
+
+    HEADER_KEY = 'RAIN PREDICTOR PREPARED STORE'
+    VERSION_KEY = 'VERSION'
+    FIRSTSEQNO_KEY = 'FIRSTSEQNO'
+    NUMSLOTS_KEY = 'NUMSLOTS'
+    DATASIZE_KEY = 'DATASIZE'
+    BITMAPOFFSET_KEY = 'BITMAPOFFSET'
+    DATAOFFSET_KEY = 'DATAOFFSET'
+    VERSION = 1
+    HEADER_LENGTH = 256
+    ALIGNMENT = 4096
+
+    def __init__(self):
+        self.pathname = None
+        self.firstSeqno = 0
+        self.numSlots = 0
+        self.datasize = 0
+        self.present = None
+        self.frames = None
+        self.writable = False
+        self.bitmapOffset = 0
+
+    def layout(self):
+        self.bitmapOffset = self.HEADER_LENGTH
+        dataOffset = self.bitmapOffset + (self.numSlots + 7) // 8
+        return ( (dataOffset + self.ALIGNMENT - 1)
+                 // self.ALIGNMENT * self.ALIGNMENT )
+
+    def create(self, filename, firstSeqno, lastSeqno, datasize):
+        """
+        Creates an empty store covering the given range of sequence
+        numbers.  Fill it with setFrame, then close it.
+        """
+        self.pathname = filename
+        self.firstSeqno = firstSeqno
+        self.numSlots = lastSeqno - firstSeqno + 1
+        self.datasize = datasize
+        dataOffset = self.layout()
+
+        header = ''.join('{0} {1}\n'.format(key, val) for key, val in
+                         [ (self.VERSION_KEY, self.VERSION),
+                           (self.FIRSTSEQNO_KEY, self.firstSeqno),
+                           (self.NUMSLOTS_KEY, self.numSlots),
+                           (self.DATASIZE_KEY, self.datasize),
+                           (self.BITMAPOFFSET_KEY, self.bitmapOffset),
+                           (self.DATAOFFSET_KEY, dataOffset) ])
+        header = ('{0}\n'.format(self.HEADER_KEY) + header).encode('ascii')
+        if len(header) > self.HEADER_LENGTH:
+            raise RpBinFileReadError('Store header too long')
+
+        with open(filename, 'wb') as ofile:
+            ofile.write(header)
+            ofile.truncate(dataOffset + self.numSlots * self.datasize)
+
+        self.present = np.zeros(self.numSlots, dtype=bool)
+        self.frames = np.memmap(filename, dtype=np.uint8, mode='r+',
+                                offset=dataOffset,
+                                shape=(self.numSlots, self.datasize))
+        self.writable = True
+
+    def open(self, filename, writable = False):
+        self.pathname = filename
+        fields = {}
+        with open(filename, 'rb') as istream:
+            header = istream.readline().rstrip().decode('ascii')
+            if header != self.HEADER_KEY:
+                raise RpBinFileReadError('File {0} is not a valid '
+                                         'store'.format(filename))
+            for i in range(6):
+                key, val = (istream.readline().rstrip()
+                            .decode('ascii').split(" "))
+                fields[key] = int(val)
+
+            if fields.get(self.VERSION_KEY) != self.VERSION:
+                raise RpBinFileReadError('File {0} is a store version '
+                                         'not supported by this '
+                                         'code'.format(filename))
+            self.firstSeqno = fields[self.FIRSTSEQNO_KEY]
+            self.numSlots = fields[self.NUMSLOTS_KEY]
+            self.datasize = fields[self.DATASIZE_KEY]
+            self.bitmapOffset = fields[self.BITMAPOFFSET_KEY]
+
+            istream.seek(self.bitmapOffset)
+            bitmap = np.frombuffer(istream.read((self.numSlots + 7) // 8),
+                                   dtype=np.uint8)
+            self.present = np.unpackbits(bitmap)[:self.numSlots].astype(bool)
+
+        self.writable = writable
+        self.frames = np.memmap(filename, dtype=np.uint8,
+                                mode='r+' if writable else 'r',
+                                offset=fields[self.DATAOFFSET_KEY],
+                                shape=(self.numSlots, self.datasize))
+
+    def close(self):
+        if self.writable:
+            self.frames.flush()
+            with open(self.pathname, 'r+b') as ofile:
+                ofile.seek(self.bitmapOffset)
+                ofile.write(np.packbits(self.present).tobytes())
+        self.frames = None
+        self.writable = False
+
+    def slotOf(self, seqno):
+        return seqno - self.firstSeqno
+
+    def setFrame(self, seqno, data):
+        slot = self.slotOf(seqno)
+        self.frames[slot] = np.frombuffer(bytes(data), dtype=np.uint8)
+        self.present[slot] = True
+
+    def clearFrame(self, seqno):
+        slot = self.slotOf(seqno)
+        if 0 <= slot < self.numSlots:
+            self.present[slot] = False
+
+    def hasFrame(self, seqno):
+        slot = self.slotOf(seqno)
+        return 0 <= slot < self.numSlots and bool(self.present[slot])
+
+    def hasWindow(self, seqno, length = 6):
+        slot = self.slotOf(seqno)
+        return ( 0 <= slot and slot + length <= self.numSlots
+                 and bool(self.present[slot:slot + length].all()) )
+
+    def getFrame(self, seqno):
+        if not self.hasFrame(seqno):
+            raise KeyError(seqno)
+        return self.frames[self.slotOf(seqno)]
+
+    def getWindow(self, seqno, length = 6):
+        """
+        Returns the frames for length consecutive timesteps starting at
+        seqno, as a [length, datasize] view into the store.
+        """
+        if not self.hasWindow(seqno, length):
+            raise KeyError(seqno)
+        slot = self.slotOf(seqno)
+        return self.frames[slot:slot + length]
+
+    def getFrames(self):
+        return self.frames
+
+    def getPresent(self):
+        return self.present
+
+    def getFirstSeqno(self):
+        return self.firstSeqno
+
+    def getLastSeqno(self):
+        return self.firstSeqno + self.numSlots - 1
+
+    def getDataSize(self):
+        return self.datasize
+
+
+class RpFrameIndex:
+    """
+    An index of the intermediate binary files of an archive, one
+    entry per sequence number holding the pathname, the TOTALRAIN
+    and MAXVAL header values, the rain labels from
+    prepare-true-vals.py and whether the frame is available.  Tools
+    that only need those don't have to open every file or parse the
+    text sequence file.  Lookups go through a table over the range of
+    sequence numbers, so cost one array index each, and runs of
+    consecutive available frames are found from running counts.
+
+    The index can stand in for the dict returned by loadPathMap, see
+    openPathMap.
+
+    Stored with numpy.savez as parallel arrays sorted by sequence
+    number:  seqnos, paths, totalrain, maxval, labels, available,
+    plus the format version.  Unknown values are -1.  Version 1 had
+    no labels or availability.
+    """
+
+    VERSION = 2
+    SUPPORTED_VERSIONS = [1, 2]
+
+    def __init__(self):
+        self.setEntries(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=str),
+                        np.zeros(0, dtype=np.int64),
+                        np.zeros(0, dtype=np.int64),
+                        np.zeros((0, 0), dtype=np.int8),
+                        np.zeros(0, dtype=bool))
+
+    def setEntries(self, seqnos, paths, totalRain, maxval, labels,
+                   available):
+        """
+        Sets the arrays, which must already be sorted by unique
+        sequence number, and builds the lookup tables
+        """
+        self.seqnos = seqnos
+        self.paths = paths
+        self.totalRain = totalRain
+        self.maxval = maxval
+        self.labels = labels
+        self.available = available
+
+        self.firstSeqno = 0
+        span = 0
+        if len(self.seqnos):
+            self.firstSeqno = int(self.seqnos[0])
+            span = int(self.seqnos[-1]) - self.firstSeqno + 1
+        self.rows = np.full(span, -1, dtype=np.int64)
+        self.rows[self.seqnos - self.firstSeqno] = np.arange(len(seqnos))
+
+        slotAvailable = np.zeros(span, dtype=bool)
+        slotAvailable[self.seqnos - self.firstSeqno] = self.available
+        self.availableCounts = np.concatenate(
+            [ [ 0 ], np.cumsum(slotAvailable, dtype=np.int64) ])
+
+    def load(self, filename):
+        with np.load(filename) as container:
+            version = int(container['version'])
+            if version not in self.SUPPORTED_VERSIONS:
+                raise RpBinFileReadError('File {0} is a frame index version '
+                                         'not supported by this '
+                                         'code'.format(filename))
+            seqnos = container['seqnos']
+            if version >= 2:
+                labels = container['labels']
+                available = container['available']
+            else:
+                labels = np.zeros((len(seqnos), 0), dtype=np.int8)
+                available = np.ones(len(seqnos), dtype=bool)
+            self.setEntries(seqnos, container['paths'],
+                            container['totalrain'], container['maxval'],
+                            labels, available)
+
+    def write(self, filename):
+        """
+        Writes the index to a scratch file and renames it into place
+        """
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(
+            os.path.abspath(filename)))
+        with os.fdopen(fd, 'wb') as ofile:
+            np.savez(ofile, version = self.VERSION, seqnos = self.seqnos,
+                     paths = self.paths, totalrain = self.totalRain,
+                     maxval = self.maxval, labels = self.labels,
+                     available = self.available)
+        os.replace(tmpname, filename)
+
+    def update(self, seqnos, paths = None, totalRain = None, maxval = None,
+               labels = None, available = None):
+        """
+        Adds or updates the entries for the sequence numbers.  Only
+        the values given are changed, an entry added without a value
+        gets -1, or False for availability.  Adding a path without
+        saying otherwise marks the frame available.
+        """
+        seqnos = np.asarray(seqnos, dtype=np.int64)
+        allSeqnos = np.union1d(self.seqnos, seqnos)
+        oldRows = np.searchsorted(allSeqnos, self.seqnos)
+        newRows = np.searchsorted(allSeqnos, seqnos)
+
+        def merged(current, values, fill, shape = ()):
+            rval = np.full((len(allSeqnos),) + shape, fill,
+                           dtype=current.dtype)
+            rval[(oldRows,) + tuple(slice(0, size)
+                                    for size in current.shape[1:])] = current
+            if values is not None:
+                rval[(newRows,) + tuple(slice(0, size)
+                                        for size in values.shape[1:])] = values
+            return rval
+
+        if paths is not None:
+            paths = np.asarray(paths, dtype=str)
+            pathdtype = np.result_type(self.paths.dtype, paths.dtype)
+            self.paths = self.paths.astype(pathdtype)
+            if available is None:
+                available = True
+        if labels is not None:
+            labels = np.asarray(labels, dtype=np.int8).reshape(len(seqnos),
+                                                               -1)
+        labelWidth = max(self.labels.shape[1],
+                         0 if labels is None else labels.shape[1])
+        if available is not None:
+            available = np.broadcast_to(np.asarray(available, dtype=bool),
+                                        seqnos.shape)
+
+        self.setEntries(allSeqnos,
+                        merged(self.paths, paths, ''),
+                        merged(self.totalRain, None if totalRain is None else
+                               np.asarray(totalRain, dtype=np.int64), -1),
+                        merged(self.maxval, None if maxval is None else
+                               np.asarray(maxval, dtype=np.int64), -1),
+                        merged(self.labels, labels, -1, (labelWidth,)),
+                        merged(self.available, available, False))
+
+    def __len__(self):
+        return len(self.seqnos)
+
+    def rowsOf(self, seqnos):
+        """
+        Returns the rows holding the given sequence numbers, an array
+        of the same shape with -1 where there is no entry
+        """
+        if not len(self.seqnos):
+            return np.full(np.shape(seqnos), -1, dtype=np.int64)
+        slots = np.asarray(seqnos, dtype=np.int64) - self.firstSeqno
+        inRange = (slots >= 0) & (slots < len(self.rows))
+        rval = np.full(slots.shape, -1, dtype=np.int64)
+        rval[inRange] = self.rows[slots[inRange]]
+        return rval
+
+    def checkedRowsOf(self, seqnos):
+        rows = self.rowsOf(seqnos)
+        if (rows < 0).any():
+            missing = np.asarray(seqnos)[rows < 0].ravel()[0]
+            raise KeyError(int(missing))
+        return rows
+
+    def hasSeqnos(self, seqnos):
+        return self.rowsOf(seqnos) >= 0
+
+    def hasSeqno(self, seqno):
+        slot = seqno - self.firstSeqno
+        return 0 <= slot < len(self.rows) and self.rows[slot] >= 0
+
+    def getSeqnos(self):
+        return self.seqnos
+
+    def getPath(self, seqno):
+        return str(self.paths[self.checkedRowsOf(seqno)])
+
+    def getPaths(self, seqnos):
+        return self.paths[self.checkedRowsOf(seqnos)]
+
+    def getTotalRain(self, seqnos):
+        """
+        Returns the total rain of each sequence number, in an array
+        of the same shape.  Raises KeyError if one has no entry.
+        """
+        return self.totalRain[self.checkedRowsOf(seqnos)]
+
+    def getMaxval(self, seqnos):
+        return self.maxval[self.checkedRowsOf(seqnos)]
+
+    def getLabels(self, seqnos):
+        """
+        Returns the RAIN/HEAVY_RAIN labels of each sequence number, as
+        written by prepare-true-vals.py, with a trailing axis
+        """
+        return self.labels[self.checkedRowsOf(seqnos)]
+
+    def isAvailable(self, seqnos):
+        if not len(self.seqnos):
+            return np.zeros(np.shape(seqnos), dtype=bool)
+        rows = self.rowsOf(seqnos)
+        return (rows >= 0) & self.available[np.maximum(rows, 0)]
+
+    # Range queries over the available frames
+
+    def countAvailable(self, first, last):
+        """
+        Returns the number of available frames from first to last
+        inclusive
+        """
+        span = len(self.rows)
+        lo = np.clip(np.asarray(first, dtype=np.int64)
+                     - self.firstSeqno, 0, span)
+        hi = np.clip(np.asarray(last, dtype=np.int64)
+                     - self.firstSeqno + 1, 0, span)
+        return np.maximum(self.availableCounts[hi]
+                          - self.availableCounts[lo], 0)
+
+    def hasRun(self, seqno, length = 6):
+        """
+        True if the length frames starting at seqno are all available
+        """
+        return bool(self.countAvailable(seqno, seqno + length - 1) == length)
+
+    def getRuns(self, length = 6, first = None, last = None):
+        """
+        Returns the sequence numbers, from first to last, that start
+        a run of length consecutive available frames
+        """
+        if not len(self.seqnos):
+            return np.zeros(0, dtype=np.int64)
+        if first is None:
+            first = self.firstSeqno
+        if last is None:
+            last = int(self.seqnos[-1])
+        starts = np.arange(first, last - length + 2, dtype=np.int64)
+        return starts[self.countAvailable(starts, starts + length - 1)
+                      == length]
+
+    def getRange(self, first, last):
+        """
+        Returns the sequence numbers with entries from first to last
+        inclusive
+        """
+        lo, hi = np.searchsorted(self.seqnos, [ first, last + 1 ])
+        return self.seqnos[lo:hi]
+
+    # So that the index can be used wherever a pathmap dict is.  As a
+    # mapping it holds the available frames only.
+
+    def __contains__(self, seqno):
+        return bool(self.isAvailable(seqno))
+
+    def __getitem__(self, seqno):
+        if seqno not in self:
+            raise KeyError(seqno)
+        return self.getPath(seqno)
+
+    def get(self, seqno, default = None):
+        if seqno not in self:
+            return default
+        return self.getPath(seqno)
+
+    def keys(self):
+        return self.seqnos[self.available].tolist()
+
+
+# The month input to the network, indexed by month number.
+monthdata = [ None,
+              0.16, 0, 0.16, 0.33, 0.5, 0.67,
+              0.83, 1, 0.83, 0.67, 0.5, 0.33 ]
+
+
+def sequenceNumberToDatetime(seqno):
+    """
+    The inverse of computeSequenceNumber
+    """
+    epoch = datetime.datetime(year=2015, month = 1, day = 1,
+                              hour = 0, minute = 0)
+    return epoch + datetime.timedelta(seconds = int(seqno) * 600)
 
-    hasher = hashlib.sha256()
-    hasher.update(rvalX.data.tobytes())
-    hasher.update(rvalY.data.tobytes())
-    hashval = (hasher.hexdigest())[-16:]
 
-    return rvalX, rvalY, rvalM, datasize, len(seqlist), hashval
+def datetimeToSequenceNumber(dtime):
+    """
+    The sequence number of the 10 minute interval holding dtime
+    """
+    epoch = datetime.datetime(year=2015, month = 1, day = 1,
+                              hour = 0, minute = 0)
+    return int((dtime.replace(tzinfo = None) - epoch).total_seconds() // 600)
+
+
+class RpDtypePolicy:
+    """
+    Prepared data stays as raw bytes (storageDtype) on disk and in
+    memory, and is only scaled into [0, 1] as computeDtype when it is
+    handed to the network, a batch at a time where possible.
+    """
+
+    COMPUTE_DTYPES = { 'float16': np.float16,
+                       'float32': np.float32,
+                       'float64': np.float64 }
+
+    def __init__(self, compute = 'float32'):
+        if compute not in self.COMPUTE_DTYPES:
+            raise ValueError('Unsupported compute dtype {0}, choose one '
+                             'of {1}'.format(compute,
+                                             sorted(self.COMPUTE_DTYPES)))
+        self.storageDtype = np.uint8
+        self.computeDtype = self.COMPUTE_DTYPES[compute]
+
+    def getStorageDtype(self):
+        return self.storageDtype
+
+    def getComputeDtype(self):
+        return self.computeDtype
+
+    def toStorage(self, raw):
+        return np.asarray(raw, dtype=self.storageDtype)
+
+    def toCompute(self, raw):
+        """
+        Scales raw prepared bytes into [0, 1]
+        """
+        return ( np.asarray(raw).astype(self.computeDtype)
+                 / self.computeDtype(255) )
+
+    def labels(self, yvals):
+        return np.asarray(yvals).astype(self.computeDtype)
+
+
+class RpWindowLoader:
+    """
+    Loads the prepared data for a list of candidates, each a window
+    of consecutive timesteps starting at a sequence number.
+    Consecutive candidates share most of their timesteps, so each
+    unique sequence number is read exactly once into a uint8 frame
+    table, or taken straight from a memory-mapped RpPreparedStore.
+    The [N, 6, datasize] inputs are served as a strided view over
+    the frame table, or gathered and scaled to floating point a
+    batch at a time.
+    """
+
+    def __init__(self, length = 6, policy = None):
+        self.length = length
+        self.policy = policy if policy else RpDtypePolicy()
+        self.seqlist = None
+        self.frames = None
+        self.starts = None     # frame table row of each candidate
+        self.datasize = 0
+        self.yvals = None
+        self.mvals = None
+
+    def loadCandidates(self, sequence_file, path_file = None,
+                       store = None):
+        """
+        Reads a candidates file, as written by get-training-set.py,
+        and loads the frames it needs from the .bin files named in
+        path_file, or from an RpPreparedStore.
+        """
+        seqlist = []
+        labels = []
+        with open(sequence_file, 'r') as ifile:
+            for record in ifile:
+                fields = record.split()
+                seqlist.append(int(fields[0]))
+                labels.append(list(map(int, fields[5:])))
+
+        self.yvals = self.policy.toStorage(labels)
+        self.mvals = np.asarray([ [ monthdata[sequenceNumberToDatetime(seqno)
+                                              .month] ]
+                                  for seqno in seqlist ])
+        pathmap = None
+        if path_file:
+            pathmap = openPathMap(path_file)
+        self.loadFrames(seqlist, pathmap, store)
+
+    def loadFrames(self, seqlist, pathmap = None, store = None):
+        self.seqlist = np.asarray(seqlist, dtype=np.int64)
+        offsets = np.arange(self.length, dtype=np.int64)
+
+        if store is not None:
+            missing = [ seqno for seqno in seqlist
+                        if not store.hasWindow(seqno, self.length) ]
+            if missing:
+                raise RpBinFileReadError('Store {0} is missing data for '
+                                         'sequence number {1}'
+                                         .format(store.pathname,
+                                                 missing[0]))
+            self.frames = store.getFrames()
+            self.datasize = store.getDataSize()
+            self.starts = self.seqlist - store.getFirstSeqno()
+            return
+
+        needed = np.unique((self.seqlist[:, None] + offsets).ravel())
+        self.datasize = len(readPreparedData(pathmap[int(needed[0])]))
+        self.frames = np.empty([len(needed), self.datasize],
+                               dtype=self.policy.getStorageDtype())
+        for index in range(len(needed)):
+            self.frames[index] = readPreparedData(pathmap[int(needed[index])])
+
+        # The table is sorted and each window is a run of consecutive
+        # sequence numbers, so a window is a run of consecutive rows
+        self.starts = np.searchsorted(needed, self.seqlist)
+
+    def getNumWindows(self):
+        return len(self.seqlist)
+
+    def getDataSize(self):
+        return self.datasize
+
+    def getSequenceNumbers(self):
+        return self.seqlist
+
+    def getFrames(self):
+        return self.frames
+
+    def getWindowView(self):
+        """
+        Returns a read-only [nStarts, length, datasize] view of every
+        window in the frame table, without copying.  Row
+        getStarts()[i] is candidate i.
+        """
+        nStarts = len(self.frames) - self.length + 1
+        rowStride = self.frames.strides[0]
+        return np.lib.stride_tricks.as_strided(
+            self.frames, shape=(nStarts, self.length, self.datasize),
+            strides=(rowStride, rowStride, self.frames.strides[1]),
+            writeable=False)
+
+    def getStarts(self):
+        return self.starts
+
+    def getRawX(self, indices = None):
+        """
+        Gathers the uint8 inputs for the given candidates, all of
+        them by default.
+        """
+        if indices is None:
+            indices = slice(None)
+        return self.getWindowView()[self.starts[indices]]
+
+    def getRawY(self, indices = None):
+        if indices is None:
+            indices = slice(None)
+        return self.yvals[indices]
+
+    def getX(self, indices = None, dtype = None):
+        if not dtype:
+            dtype = self.policy.getComputeDtype()
+        return self.getRawX(indices).astype(dtype) / dtype(255)
+
+    def getY(self, indices = None, dtype = None):
+        if not dtype:
+            dtype = self.policy.getComputeDtype()
+        return self.getRawY(indices).astype(dtype)
+
+    def getM(self, indices = None, dtype = None):
+        if not dtype:
+            dtype = self.policy.getComputeDtype()
+        if indices is None:
+            indices = slice(None)
+        return self.mvals[indices].astype(dtype)
+
+    def getBatch(self, start, stop, dtype = None):
+        """
+        Returns ([xvals, mvals], yvals) for candidates start to stop
+        """
+        indices = slice(start, stop)
+        return ( [ self.getX(indices, dtype), self.getM(indices, dtype) ],
+                 self.getY(indices, dtype) )
+
+    def computeHash(self, chunksize = 1024):
+        """
+        The data hash used to check that training runs see the same
+        data.  It is computed over the float64 form of the data a
+        chunk at a time, so it matches the hash of the arrays
+        getDataVectors has always returned.
+        """
+        hasher = hashlib.sha256()
+        for start in range(0, self.getNumWindows(), chunksize):
+            hasher.update(self.getX(slice(start, start + chunksize),
+                                    np.float64).tobytes())
+        hasher.update(self.getY(dtype=np.float64).tobytes())
+        return (hasher.hexdigest())[-16:]
+
+
+def getDataVectors(sequence_file, path_file, store = None, policy = None):
+    """
+    Loads the inputs and labels for a candidates file.  Without a
+    policy the inputs are scaled float64 arrays, as they always
+    were.  With an RpDtypePolicy the inputs and labels come back as
+    raw storage bytes, to be scaled with policy.toCompute when
+    needed, and the month field in the compute dtype.
+    """
+    loader = RpWindowLoader(policy = policy)
+    loader.loadCandidates(sequence_file, path_file, store)
+
+    if policy:
+        rvalX = loader.getRawX()
+        rvalY = loader.getRawY()
+        rvalM = loader.getM()
+    else:
+        rvalX = loader.getX(dtype=np.float64)
+        rvalY = loader.getY(dtype=np.float64)
+        rvalM = loader.getM(dtype=np.float64)   # month field
+
+    return (rvalX, rvalY, rvalM, loader.getDataSize(),
+            loader.getNumWindows(), loader.computeHash())
+
+
+class RpVetoSet:
+    """
+    A set of sequence numbers, such as the candidates vetoed by
+    make-vetoes.py, held as a bitmap over the range they span.
+    Membership is a single index, and whole lists of records can be
+    filtered at once.  The file form is one sequence number per line,
+    as the first field.
+    """
+
+    def __init__(self, seqnos = ()):
+        self.setSeqnos(seqnos)
+
+    def setSeqnos(self, seqnos):
+        seqnos = np.unique(np.asarray(list(seqnos), dtype=np.int64))
+        self.firstSeqno = int(seqnos[0]) if len(seqnos) else 0
+        self.bitmap = np.zeros(len(seqnos) and
+                               int(seqnos[-1]) - self.firstSeqno + 1,
+                               dtype=bool)
+        self.bitmap[seqnos - self.firstSeqno] = True
+        self.count = len(seqnos)
+
+    def load(self, filename):
+        seqnos = []
+        with open(filename, 'r') as ifile:
+            for record in ifile:
+                fields = record.split()
+                if fields:
+                    seqnos.append(int(fields[0]))
+        self.setSeqnos(seqnos)
+
+    def write(self, filename):
+        with open(filename, 'w') as ofile:
+            for seqno in self.getSeqnos():
+                ofile.write('{}\n'.format(seqno))
+
+    def getSeqnos(self):
+        return (np.nonzero(self.bitmap)[0] + self.firstSeqno).tolist()
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, seqno):
+        slot = seqno - self.firstSeqno
+        return 0 <= slot < len(self.bitmap) and bool(self.bitmap[slot])
+
+    def contains(self, seqnos):
+        """
+        Returns a boolean array, True for each of the sequence numbers
+        that is in the set
+        """
+        slots = np.asarray(seqnos, dtype=np.int64) - self.firstSeqno
+        inRange = (slots >= 0) & (slots < len(self.bitmap))
+        rval = np.zeros(len(slots), dtype=bool)
+        rval[inRange] = self.bitmap[slots[inRange]]
+        return rval
+
+    def filterRecords(self, records):
+        """
+        Returns the records whose first field is a sequence number
+        not in the set
+        """
+        seqnos = [ int(record.split(None, 1)[0]) for record in records ]
+        keep = ~self.contains(seqnos)
+        return [ record for record, kept in zip(records, keep) if kept ]
+
+    def filterFile(self, infile, outfile):
+        """
+        Copies the records of infile that are not vetoed to outfile,
+        returns the number written
+        """
+        with open(infile, 'r') as ifile:
+            records = self.filterRecords(ifile.readlines())
+        with open(outfile, 'w') as ofile:
+            ofile.writelines(records)
+        return len(records)
+
+
+class RpVectorCache:
+    """
+    A directory of cached training arrays, each entry keyed by a
+    digest of everything that went into it:  the candidate files,
+    the pathfile, the size and modification time of every .bin file
+    (or store) the candidates read, and any caller-supplied settings.
+    A changed input gives a new key, so an entry is never stale.
+    Arrays are saved as separate .npy files and loaded memory-mapped.
+    The least recently used entries are evicted beyond maxEntries.
+
+    Each entry is a subdirectory named by its key, holding one .npy
+    file per array and an INFO file of <KEY> <VALUE> lines.
+    """
+
+    INFO_FILE = 'INFO'
+
+    def __init__(self, cachedir, maxEntries = 4):
+        self.cachedir = cachedir
+        self.maxEntries = maxEntries
+
+    def computeKey(self, sequence_files, path_file = None,
+                   store_file = None, extras = (), length = 6):
+        """
+        Returns the key for the arrays built from the candidate files
+        with the given pathfile, or store file if the frames come
+        from an RpPreparedStore.
+        """
+        hasher = hashlib.sha256()
+        for extra in extras:
+            hasher.update('{0}\n'.format(extra).encode('utf-8'))
+
+        seqnos = set()
+        for filename in sequence_files:
+            with open(filename, 'rb') as ifile:
+                contents = ifile.read()
+            hasher.update('{0}\n'.format(len(contents)).encode('utf-8'))
+            hasher.update(contents)
+            for record in contents.splitlines():
+                fields = record.split()
+                if fields:
+                    first = int(fields[0])
+                    seqnos.update(range(first, first + length))
+
+        if store_file:
+            statfiles = [ store_file ]
+        else:
+            with open(path_file, 'rb') as ifile:
+                hasher.update(ifile.read())
+            pathmap = openPathMap(path_file)
+            statfiles = [ pathmap.get(seqno, '') for seqno in sorted(seqnos) ]
+
+        for filename in statfiles:
+            try:
+                st = os.stat(filename)
+                stamp = '{0} {1} {2}\n'.format(filename, st.st_size,
+                                               st.st_mtime_ns)
+            except OSError:
+                stamp = '{0} missing\n'.format(filename)
+            hasher.update(stamp.encode('utf-8'))
+
+        return hasher.hexdigest()[:32]
+
+    def entryDir(self, key):
+        return os.path.join(self.cachedir, key)
+
+    def load(self, key, mmap_mode = 'r'):
+        """
+        Returns (arrays, info) for a key, two dicts, or None if the
+        key is not cached.
+        """
+        entry = self.entryDir(key)
+        info = {}
+        try:
+            with open(os.path.join(entry, self.INFO_FILE), 'r') as ifile:
+                for record in ifile:
+                    fields = record.split(None, 1)
+                    info[fields[0]] = fields[1].rstrip('\n')
+            arrays = {}
+            for name in info['ARRAYS'].split():
+                arrays[name] = np.load(os.path.join(entry, name + '.npy'),
+                                       mmap_mode = mmap_mode)
+        except (OSError, ValueError, KeyError, IndexError):
+            return None
+
+        # Loading counts as a use
+        os.utime(entry)
+        return arrays, info
+
+    def save(self, key, arrays, info = None):
+        """
+        Stores a dict of arrays, and a dict of string-valued info,
+        under the key.  The entry is built in a scratch directory and
+        renamed into place, so readers never see it half written.
+        """
+        os.makedirs(self.cachedir, exist_ok=True)
+        scratch = tempfile.mkdtemp(dir=self.cachedir, prefix='.tmp')
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(scratch, name + '.npy'), array)
+            with open(os.path.join(scratch, self.INFO_FILE), 'w') as ofile:
+                ofile.write('ARRAYS {0}\n'.format(' '.join(arrays)))
+                for infokey, val in (info or {}).items():
+                    ofile.write('{0} {1}\n'.format(infokey, val))
+
+            entry = self.entryDir(key)
+            if os.path.exists(entry):
+                shutil.rmtree(entry)
+            os.rename(scratch, entry)
+        except OSError:
+            shutil.rmtree(scratch, ignore_errors=True)
+            raise
+
+        self.evict()
+
+    def getEntries(self):
+        """
+        Returns the cached keys, most recently used first
+        """
+        try:
+            names = [ name for name in os.listdir(self.cachedir)
+                      if not name.startswith('.') and
+                      os.path.isdir(self.entryDir(name)) ]
+        except OSError:
+            return []
+        return sorted(names, key=lambda name:
+                      os.stat(self.entryDir(name)).st_mtime_ns,
+                      reverse=True)
+
+    def evict(self):
+        for key in self.getEntries()[self.maxEntries:]:
+            shutil.rmtree(self.entryDir(key), ignore_errors=True)
 
 
 
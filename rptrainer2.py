@@ -3,6 +3,7 @@
 # Here we go again.  Training the neural network.
 
 import rpreddtypes
+import rpgenerator3
 import argparse
 import random
 import hashlib
@@ -46,6 +47,14 @@ num_outputs = 10
 classweights = { 0:1.0, 1:0.5, 2:0.9, 3:0.45, 4:0.8,
                  5:0.4, 6:0.7, 7:0.35, 8:0.6, 9:0.3 }
 
+# Version 1 of savedvecs.npz held float64 arrays.  Version 2 holds the
+# raw uint8 inputs and labels, scaled at training time.  Version 3
+# moves them into an RpVectorCache keyed by the input data.
+savedvecsVersion = 3
+
+expectedHash = '968918db5a466fa9'
+batchSize = 512
+
 
 parser = argparse.ArgumentParser(description='Train the rain '
                                  'prediction network.')
@@ -56,7 +65,8 @@ parser.add_argument('--continue', dest='Continue',
 parser.add_argument('--pathfile', type=str, dest='pathfile',
                     required=True,
                     help='The file that maps sequence numbers to '
-                    'the pathnames of the binary files.')
+                    'the pathnames of the binary files, the output of '
+                    'prepare-true-vals.py or a frame index.')
 parser.add_argument('--training-set', type=str, dest='trainingset',
                     required=True,
                     help='The file containing the training set '
@@ -73,9 +83,26 @@ parser.add_argument('--savefile', type=str, dest='savefile',
                     'incompatibility.')
 parser.add_argument('--saved-vecs-dir', type=str, dest='savedvecs',
                     help='A directory to hold pre-loaded training '
-                    'and validation data.  If files are present, '
+                    'and validation data.  Entries are keyed by the '
+                    'candidate files, the pathfile and the binary '
+                    'files they name.  If a matching entry is present, '
                     'will load from there, otherwise it will load '
                     'as normal and save there.')
+parser.add_argument('--saved-vecs-entries', type=int,
+                    dest='savedvecsEntries', default=4,
+                    help='The number of entries to keep in the '
+                    '--saved-vecs-dir cache, the least recently used '
+                    'are removed.')
+parser.add_argument('--store', type=str, dest='store',
+                    help='A prepared-data store built by '
+                    'make-prepared-store.py.  If given, inputs are read '
+                    'from it instead of the binary files.')
+parser.add_argument('--streaming', action='store_true',
+                    dest='streaming',
+                    help='Stream batches to the network from an '
+                    'in-memory frame table, rather than loading the '
+                    'whole training and validation sets as arrays.  '
+                    '--saved-vecs-dir is not used in this mode.')
 parser.add_argument('--holdout0', type=str, dest='holdout0',
                     help='The holdout dataset used for final '
                     'validation, no rain at present')
@@ -100,6 +127,12 @@ parser.add_argument('--set-optimizer', type=int, dest='optimizer',
                     '0 - SVD\n  1 - RMSprop\n  2 - Adagrad\n  '
                     '3 - Adadelta\n  4 - Adam\n  5 - Adamax\n  '
                     '6 - Nadam')
+parser.add_argument('--dtype', type=str, dest='dtype',
+                    default='float32',
+                    choices=sorted(rpreddtypes.RpDtypePolicy.COMPUTE_DTYPES),
+                    help='The floating point type in which inputs are '
+                    'handed to the network.  They are held as raw bytes '
+                    'until then.')
 parser.add_argument('--name', type=str, dest='name',
                     required=True,
                     help='A name to distinguish this run.  It '
@@ -108,6 +141,8 @@ parser.add_argument('--name', type=str, dest='name',
 
 args = parser.parse_args()
 
+policy = rpreddtypes.RpDtypePolicy(args.dtype)
+
 
 xvals = None
 yvals = None
@@ -123,13 +158,57 @@ datasize = None
 npts = None
 hashval = None
 
-if args.nEpochs > 0:
+trainGen = None
+validGen = None
+
+store = None
+if args.store:
+    store = rpreddtypes.RpPreparedStore()
+    store.open(args.store)
+
+if args.nEpochs > 0 and args.streaming:
+    trainGen = rpgenerator3.RPDataGenerator3(args.trainingset, args.pathfile,
+                                             store = store,
+                                             batch_size = batchSize,
+                                             shuffle = True,
+                                             policy = policy)
+    if not args.nohash:
+        hashval = trainGen.getHash()
+        if hashval != expectedHash:
+            print('Unexpected hash value {0}.  Input data may have changed.'
+                  .format(hashval))
+            sys.exit(1)
+
+    validGen = rpgenerator3.RPDataGenerator3(args.validationset,
+                                             args.pathfile,
+                                             store = store,
+                                             batch_size = batchSize,
+                                             shuffle = False,
+                                             policy = policy)
+    datasize = trainGen.getInputSize()
+
+elif args.nEpochs > 0:
 
     needload = True
+    cache = None
+    cachekey = None
     if args.savedvecs:
-        if os.path.exists(args.savedvecs + '/savedvecs.npz'):
+        cache = rpreddtypes.RpVectorCache(args.savedvecs,
+                                          maxEntries = args.savedvecsEntries)
+        cachekey = cache.computeKey([args.trainingset, args.validationset],
+                                    args.pathfile, store_file = args.store,
+                                    extras = [savedvecsVersion])
+        cached = cache.load(cachekey)
+        if cached:
+            container, info = cached
+            hashval = info.get('HASH')
+            if not args.nohash and hashval != expectedHash:
+                print('Unexpected hash value {0}.  Input data may have changed.'
+                      .format(hashval))
+                sys.exit(1)
             needload = False
-            container = np.load(args.savedvecs + '/savedvecs.npz')
+
+        if not needload:
             xvals = container['xvals']
             yvals = container['yvals']
             mvals = container['mvals']
@@ -139,23 +218,22 @@ if args.nEpochs > 0:
             datasize = xvals.shape[2]
 
     if needload:
-        xvals, yvals, mvals, datasize, npts, hashval = rpreddtypes.getDataVectors(args.trainingset, args.pathfile)
+        xvals, yvals, mvals, datasize, npts, hashval = rpreddtypes.getDataVectors(args.trainingset, args.pathfile, store = store, policy = policy)
 
         if not args.nohash:
-            if hashval != '968918db5a466fa9':
+            if hashval != expectedHash:
                 print('Unexpected hash value {0}.  Input data may have changed.'
                       .format(hashval))
                 sys.exit(1)
 
-        vxvals, vyvals, vmvals, vdatasize, vnpts, vhashval = rpreddtypes.getDataVectors(args.validationset, args.pathfile)
-
-        if args.savedvecs:
-            if not os.path.exists(args.savedvecs):
-                os.mkdir(args.savedvecs)
+        vxvals, vyvals, vmvals, vdatasize, vnpts, vhashval = rpreddtypes.getDataVectors(args.validationset, args.pathfile, store = store, policy = policy)
 
-            np.savez(args.savedvecs + '/savedvecs.npz',
-                     xvals = xvals, yvals = yvals, mvals = mvals,
-                     vxvals = vxvals, vyvals = vyvals, vmvals = vmvals)
+        if cache:
+            cache.save(cachekey,
+                       { 'xvals': xvals, 'yvals': yvals, 'mvals': mvals,
+                         'vxvals': vxvals, 'vyvals': vyvals,
+                         'vmvals': vmvals },
+                       { 'HASH': hashval })
 
 
 useoptimizer = keras.optimizers.Adadelta()
@@ -230,11 +308,24 @@ if args.nEpochs > 0:
     if args.tensorboard:
         calllist.append(cb2)
 
-    history = mymodel.fit(x = [xvals, mvals], y = yvals, epochs = args.nEpochs,
-                          class_weight = classweights,
-                          validation_data = [[vxvals, vmvals], vyvals],
-                          verbose=1, batch_size = 512,
-                          shuffle = True, callbacks = calllist)
+    if trainGen:
+        history = mymodel.fit(x = trainGen, epochs = args.nEpochs,
+                              class_weight = classweights,
+                              validation_data = validGen,
+                              verbose=1, callbacks = calllist)
+    else:
+        # The arrays stay raw, each batch is scaled as it is served
+        trainGen = rpgenerator3.RPArrayGenerator(xvals, mvals, yvals,
+                                                 batch_size = batchSize,
+                                                 shuffle = True,
+                                                 policy = policy)
+        validGen = rpgenerator3.RPArrayGenerator(vxvals, vmvals, vyvals,
+                                                 batch_size = batchSize,
+                                                 policy = policy)
+        history = mymodel.fit(x = trainGen, epochs = args.nEpochs,
+                              class_weight = classweights,
+                              validation_data = validGen,
+                              verbose=1, callbacks = calllist)
 
     histdir = "histories/" + args.name
     if not os.path.exists(histdir):
@@ -276,14 +367,17 @@ if args.holdout0 or args.holdout1:
         # This is the branch when it is not currently raining, but it
         # will rain soon.
 
-        hxvals, hyvals, hjunk0, hjunk1, hnpts, hjunk2 = rpreddtypes.getDataVectors(args.holdout0, args.pathfile)
+        hxvals, hyvals, hmvals, hjunk1, hnpts, hjunk2 = rpreddtypes.getDataVectors(args.holdout0, args.pathfile, store = store, policy = policy)
 
         willRainIn2 = 0
         predWillRainIn1or2 = 0
         willRainIn3plus = 0
         predWillRainIn3plus = 0
         
-        hypred = mymodel.predict(x = hxvals)
+        hypred = mymodel.predict(
+            x = rpgenerator3.RPArrayGenerator(hxvals, hmvals,
+                                              batch_size = batchSize,
+                                              policy = policy))
         for datapt in range(hnpts):
 
             if hyvals[datapt, 0] == 0 and hyvals[datapt, 2] == 1:
@@ -316,14 +410,17 @@ if args.holdout0 or args.holdout1:
         
         
     if args.holdout1:
-        hxvals, hyvals, hjunk0, hjunk1, hnpts, hjunk2 = rpreddtypes.getDataVectors(args.holdout1, args.pathfile)
+        hxvals, hyvals, hmvals, hjunk1, hnpts, hjunk2 = rpreddtypes.getDataVectors(args.holdout1, args.pathfile, store = store, policy = policy)
 
         willStopIn1 = 0
         predWillStopIn1 = 0
         willStopIn3plus = 0
         predWillStopIn3plus = 0
 
-        hypred = mymodel.predict(x = hxvals)
+        hypred = mymodel.predict(
+            x = rpgenerator3.RPArrayGenerator(hxvals, hmvals,
+                                              batch_size = batchSize,
+                                              policy = policy))
         for datapt in range(hnpts):
 
             if hyvals[datapt, 0] == 0: